@@ -8,13 +8,20 @@
     :copyright: (c) Copyright 2008-2011 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
-from StringIO import StringIO
-from ast import NodeVisitor, If, Name, Pass
+from copy import deepcopy
+from io import StringIO
+from ast import NodeVisitor, If, Name, Pass, Attribute, BinOp, Call, \
+     Subscript, Constant, Tuple, List, Set, Dict, UnaryOp, USub, Pow, \
+     Compare, IfExp, Expr, Assign, Lambda, Yield, YieldFrom, BitOr, \
+     MatchAs, MatchOr
+from optimize import optimize as optimize_tree
 from mapping import BOOLOP_SYMBOLS, BINOP_SYMBOLS, UNARYOP_SYMBOLS, \
-     CMPOP_SYMBOLS
+     CMPOP_SYMBOLS, PRECEDENCE, ATOM_PRECEDENCE, precedence
 
 
-def to_source(node, indent_with=' ' * 4, add_line_information=False):
+def to_source(node, indent_with=' ' * 4, add_line_information=False,
+              profiler=None, wrap_width=None, compact=False,
+              strip_docstrings=False, strip_comments=False, optimize=False):
     """This function can convert a node tree back into python sourcecode.
     This is useful for debugging purposes, especially if you're dealing with
     custom asts not generated by python itself.
@@ -31,16 +38,38 @@ def to_source(node, indent_with=' ' * 4, add_line_information=False):
     If `add_line_information` is set to `True` comments for the line numbers
     of the nodes are added to the output.  This can be used to spot wrong line
     number information of statement nodes.
+
+    If a `profiling.Profiler` is passed as `profiler` the time spent on
+    every node type and `visit_*` method is recorded in it.
+
+    List, tuple, set and dict literals made up of constants only are written
+    in one go instead of node by node.  If `wrap_width` is set, those longer
+    than `wrap_width` characters are broken into lines of about that length.
+
+    If `compact` is set to `True` the output is meant for machines rather
+    than people: it is indented by a single space and has no blank lines.
+    `strip_docstrings` and `strip_comments` leave out docstrings and comments.
+
+    If `optimize` is set to `True` a copy of the tree is run through
+    `optimize.optimize` first, which folds constants and drops dead code.
     """
+    if compact:
+        indent_with = ' '
+    if optimize:
+        node = optimize_tree(deepcopy(node))
     out = StringIO()
-    generator = SourceGenerator(indent_with, out, add_line_information)
+    generator = SourceGenerator(indent_with, out, add_line_information,
+                                wrap_width, compact, strip_docstrings,
+                                strip_comments)
+    if profiler is not None:
+        profiler.instrument(generator)
     generator.visit(node)
     
     gen_code = out.getvalue()
     lines = gen_code.split('\n')
     
     # Post-processing comments
-    for i in xrange(len(lines)):
+    for i in range(len(lines)):
         line = lines[i]
         if line.strip().startswith("__comment__ = '"):
             line = line.replace("__comment__ = '", '#',  1).replace("\\'", "'")[0:-1]
@@ -50,17 +79,120 @@ def to_source(node, indent_with=' ' * 4, add_line_information=False):
     return '\n'.join(lines)
 
 
+def is_docstring(stmt):
+    return isinstance(stmt, Expr) and isinstance(stmt.value, Constant) and \
+           isinstance(stmt.value.value, str)
+
+
+def is_comment(stmt):
+    """Checks if `stmt` is a comment that went through the `__comment__`
+    pre-processing.
+    """
+    return isinstance(stmt, Assign) and len(stmt.targets) == 1 and \
+           isinstance(stmt.targets[0], Name) and \
+           stmt.targets[0].id == '__comment__'
+
+
+def constant_source(node):
+    """Returns the source of `node` if it is a literal made up of constants
+    only, otherwise `None`.
+    """
+    # exact class checks, this runs once per element of huge data tables
+    cls = node.__class__
+    if cls is Constant:
+        return constant_repr(node)
+    elif cls is UnaryOp:
+        if node.op.__class__ is USub and node.operand.__class__ is Constant:
+            return '-' + constant_repr(node.operand)
+    else:
+        items = constant_items(node)
+        if items is not None:
+            left, right = container_brackets(node, items)
+            return left + ', '.join(items) + right
+    return None
+
+
+def constant_items(node):
+    """Returns the sources of the items of the list, tuple, set or dict
+    literal `node` if they are all constant, otherwise `None`.
+    """
+    items = []
+    append = items.append
+    cls = node.__class__
+    if cls is List or cls is Tuple or cls is Set:
+        for element in node.elts:
+            if element.__class__ is Constant:
+                append(constant_repr(element))
+            else:
+                source = constant_source(element)
+                if source is None:
+                    return None
+                append(source)
+    elif cls is Dict:
+        for key, value in zip(node.keys, node.values):
+            if key is None:
+                # ``**mapping``
+                return None
+            key_source = constant_source(key)
+            if key_source is None:
+                return None
+            value_source = constant_source(value)
+            if value_source is None:
+                return None
+            append(key_source + ': ' + value_source)
+    else:
+        return None
+    return items
+
+
+def constant_repr(node):
+    value = node.value
+    if value is Ellipsis:
+        return '...'
+    elif isinstance(value, (float, complex)):
+        # literals too large for a float are infinite
+        return repr(value).replace('inf', '1e309')
+    elif node.kind == 'u':
+        return 'u' + repr(value)
+    return repr(value)
+
+
+def string_body(value, quote):
+    """Returns the string `value` escaped for a literal delimited by
+    `quote`, without the delimiters.
+    """
+    literal = repr(value)
+    body = literal[1:-1]
+    if literal[0] != quote[0]:
+        body = body.replace(quote[0], '\\' + quote[0])
+    return body
+
+
+def container_brackets(node, items):
+    if isinstance(node, Tuple):
+        return '(', len(items) == 1 and ',)' or ')'
+    elif isinstance(node, List):
+        return '[', ']'
+    return '{', '}'
+
+
 class SourceGenerator(NodeVisitor):
     """This visitor is able to transform a well formed syntax tree into python
     sourcecode.  For more details have a look at the docstring of the
     `node_to_source` function.
     """
 
-    def __init__(self, indent_with, stream, add_line_information=False):
+    def __init__(self, indent_with, stream, add_line_information=False,
+                 wrap_width=None, compact=False, strip_docstrings=False,
+                 strip_comments=False):
         self.stream = stream
         self._new = True
         self.indent_with = indent_with
         self.add_line_information = add_line_information
+        self.wrap_width = wrap_width
+        self.compact = compact
+        self.strip_docstrings = strip_docstrings
+        self.strip_comments = strip_comments
         self.indentation = 0
         self.new_lines = 0
 
@@ -75,12 +207,26 @@ class SourceGenerator(NodeVisitor):
         self._new = False
 
     def newline(self, node=None, extra=0):
+        if self.compact:
+            extra = 0
         self.new_lines = max(self.new_lines, 1 + extra)
         if node is not None and self.add_line_information:
             self.write('# line: %s' % node.lineno)
             self.new_lines = 1
 
-    def body(self, statements):
+    def statements(self, statements, docstring=False):
+        """Returns the statements of a body that are written out.  The first
+        one is a docstring if `docstring` is set.
+        """
+        if self.strip_docstrings and docstring and statements and \
+           is_docstring(statements[0]):
+            statements = statements[1:]
+        if self.strip_comments:
+            statements = [stmt for stmt in statements if not is_comment(stmt)]
+        return statements
+
+    def body(self, statements, docstring=False):
+        statements = self.statements(statements, docstring)
         self.new_line = True
         self.indentation += 1
         for stmt in statements:
@@ -104,19 +250,34 @@ class SourceGenerator(NodeVisitor):
             else:
                 want_comma.append(True)
 
-        padding = [None] * (len(node.args) - len(node.defaults))
-        for arg, default in zip(node.args, padding + node.defaults):
+        def write_arg(arg, default):
             write_comma()
             self.visit(arg)
             if default is not None:
-                self.write('=')
+                self.write(arg.annotation is None and '=' or ' = ')
                 self.visit(default)
+
+        positional = node.posonlyargs + node.args
+        padding = [None] * (len(positional) - len(node.defaults))
+        for idx, (arg, default) in enumerate(zip(positional,
+                                                 padding + node.defaults)):
+            write_arg(arg, default)
+            if idx + 1 == len(node.posonlyargs):
+                write_comma()
+                self.write('/')
         if node.vararg is not None:
             write_comma()
-            self.write('*' + node.vararg)
+            self.write('*')
+            self.visit(node.vararg)
+        elif node.kwonlyargs:
+            write_comma()
+            self.write('*')
+        for arg, default in zip(node.kwonlyargs, node.kw_defaults):
+            write_arg(arg, default)
         if node.kwarg is not None:
             write_comma()
-            self.write('**' + node.kwarg)
+            self.write('**')
+            self.visit(node.kwarg)
 
     def decorators(self, node):
         for decorator in node.decorator_list:
@@ -128,22 +289,35 @@ class SourceGenerator(NodeVisitor):
 
     def visit_Assign(self, node):
         self.newline(node)
-        for idx, target in enumerate(node.targets):
-            if idx:
-                self.write(', ')
+        for target in node.targets:
             self.visit(target)
-        self.write(' = ')
-        self.visit(node.value)
+            self.write(' = ')
+        self.statement_value(node.value)
+
+    def visit_AnnAssign(self, node):
+        self.newline(node)
+        if not node.simple and isinstance(node.target, Name):
+            self.write('(')
+            self.visit(node.target)
+            self.write(')')
+        else:
+            self.visit(node.target)
+        self.write(': ')
+        self.visit(node.annotation)
+        if node.value is not None:
+            self.write(' = ')
+            self.statement_value(node.value)
 
     def visit_AugAssign(self, node):
         self.newline(node)
         self.visit(node.target)
         self.write(' '+BINOP_SYMBOLS[type(node.op)] + '= ')
-        self.visit(node.value)
+        self.statement_value(node.value)
 
     def visit_ImportFrom(self, node):
         self.newline(node)
-        self.write('from %s%s import ' % ('.' * node.level, node.module))
+        self.write('from %s%s import ' % ('.' * node.level,
+                                          node.module or ''))
         for idx, item in enumerate(node.names):
             if idx:
                 self.write(', ')
@@ -151,22 +325,35 @@ class SourceGenerator(NodeVisitor):
 
     def visit_Import(self, node):
         self.newline(node)
-        for item in node.names:
-            self.write('import ')
+        self.write('import ')
+        for idx, item in enumerate(node.names):
+            if idx:
+                self.write(', ')
             self.visit(item)
 
+    def visit_Module(self, node):
+        for stmt in self.statements(node.body, docstring=True):
+            self.visit(stmt)
+
     def visit_Expr(self, node):
         self.newline(node)
-        self.generic_visit(node)
+        self.statement_value(node.value)
 
-    def visit_FunctionDef(self, node):
+    def visit_FunctionDef(self, node, prefix=''):
         self.newline(extra=1)
         self.decorators(node)
         self.newline(node)
-        self.write('def %s(' % node.name)
+        self.write('%sdef %s(' % (prefix, node.name))
         self.signature(node.args)
-        self.write('):')
-        self.body(node.body)
+        self.write(')')
+        if node.returns is not None:
+            self.write(' -> ')
+            self.visit(node.returns)
+        self.write(':')
+        self.body(node.body, docstring=True)
+
+    def visit_AsyncFunctionDef(self, node):
+        self.visit_FunctionDef(node, 'async ')
 
     def visit_ClassDef(self, node):
         have_args = []
@@ -184,23 +371,11 @@ class SourceGenerator(NodeVisitor):
         for base in node.bases:
             paren_or_comma()
             self.visit(base)
-        # XXX: the 'if' here is used to keep this module compatible
-        #      with python 2.6.
-        if hasattr(node, 'keywords'):
-            for keyword in node.keywords:
-                paren_or_comma()
-                self.write(keyword.arg + '=')
-                self.visit(keyword.value)
-            if node.starargs is not None:
-                paren_or_comma()
-                self.write('*')
-                self.visit(node.starargs)
-            if node.kwargs is not None:
-                paren_or_comma()
-                self.write('**')
-                self.visit(node.kwargs)
+        for keyword in node.keywords:
+            paren_or_comma()
+            self.visit(keyword)
         self.write(have_args and '):' or ':')
-        self.body(node.body)
+        self.body(node.body, docstring=True)
 
     def visit_If(self, node):
         self.newline(node)
@@ -224,9 +399,9 @@ class SourceGenerator(NodeVisitor):
                     self.body(else_)
                 break
 
-    def visit_For(self, node):
+    def visit_For(self, node, prefix=''):
         self.newline(node)
-        self.write('for ')
+        self.write(prefix + 'for ')
         self.visit(node.target)
         self.write(' in ')
         self.visit(node.iter)
@@ -240,36 +415,36 @@ class SourceGenerator(NodeVisitor):
         self.write(':')
         self.body_or_else(node)
 
-    def visit_With(self, node):
+    def visit_Match(self, node):
+        self.newline(node)
+        self.write('match ')
+        self.visit(node.subject)
+        self.write(':')
+        self.body(node.cases)
+
+    def visit_AsyncFor(self, node):
+        self.visit_For(node, 'async ')
+
+    def visit_With(self, node, prefix=''):
         self.newline(node)
-        self.write('with ')
-        self.visit(node.context_expr)
-        if node.optional_vars is not None:
-            self.write(' as ')
-            self.visit(node.optional_vars)
+        self.write(prefix + 'with ')
+        for idx, item in enumerate(node.items):
+            if idx:
+                self.write(', ')
+            self.visit(item.context_expr)
+            if item.optional_vars is not None:
+                self.write(' as ')
+                self.visit(item.optional_vars)
         self.write(':')
         self.body(node.body)
 
+    def visit_AsyncWith(self, node):
+        self.visit_With(node, 'async ')
+
     def visit_Pass(self, node):
         self.newline(node)
         self.write('pass')
 
-    def visit_Print(self, node):
-        self.newline(node)
-        self.write('print ')
-        want_comma = False
-        if node.dest is not None:
-            self.write(' >> ')
-            self.visit(node.dest)
-            want_comma = True
-        for value in node.values:
-            if want_comma:
-                self.write(', ')
-            self.visit(value)
-            want_comma = True
-        if not node.nl:
-            self.write(',')
-
     def visit_Delete(self, node):
         self.newline(node)
         self.write('del ')
@@ -278,24 +453,31 @@ class SourceGenerator(NodeVisitor):
                 self.write(', ')
             self.visit(target)
 
-    def visit_ExceptHandler(self, node):
-        'Not sure why these are different classes, but in py2.7 this is needed'
-        return self.visit_excepthandler(node)
+    def visit_Assert(self, node):
+        self.newline(node)
+        self.write('assert ')
+        self.visit(node.test)
+        if node.msg is not None:
+            self.write(', ')
+            self.visit(node.msg)
 
-    def visit_TryExcept(self, node):
+    def visit_Try(self, node, star=''):
         self.newline(node)
         self.write('try:')
         self.body(node.body)
         for handler in node.handlers:
-            self.visit(handler)
+            self.visit_ExceptHandler(handler, star)
+        if node.orelse:
+            self.newline()
+            self.write('else:')
+            self.body(node.orelse)
+        if node.finalbody:
+            self.newline()
+            self.write('finally:')
+            self.body(node.finalbody)
 
-    def visit_TryFinally(self, node):
-        self.newline(node)
-        self.write('try:')
-        self.body(node.body)
-        self.newline(node)
-        self.write('finally:')
-        self.body(node.finalbody)
+    def visit_TryStar(self, node):
+        self.visit_Try(node, '*')
 
     def visit_Global(self, node):
         self.newline(node)
@@ -321,31 +503,68 @@ class SourceGenerator(NodeVisitor):
         self.write('continue')
 
     def visit_Raise(self, node):
-        # XXX: Python 2.6 / 3.0 compatibility
         self.newline(node)
         self.write('raise')
-        if hasattr(node, 'exc') and node.exc is not None:
+        if node.exc is not None:
             self.write(' ')
             self.visit(node.exc)
             if node.cause is not None:
                 self.write(' from ')
                 self.visit(node.cause)
-        elif hasattr(node, 'type') and node.type is not None:
-            self.visit(node.type)
-            if node.inst is not None:
-                self.write(', ')
-                self.visit(node.inst)
-            if node.tback is not None:
-                self.write(', ')
-                self.visit(node.tback)
 
     # Expressions
 
-    def visit_Attribute(self, node):
-        self.visit(node.value)
-        self.write('.' + node.attr)
+    def chain(self, node):
+        """Splits the chain of attribute accesses, calls and subscripts
+        `node` into the expression it starts with and its links, outermost
+        first.  Long chains like ``a.b().c().d()`` are rendered from this in a
+        loop instead of recursing once per link.
+        """
+        links = []
+        while True:
+            if isinstance(node, (Attribute, Subscript)):
+                links.append(node)
+                node = node.value
+            elif isinstance(node, Call):
+                links.append(node)
+                node = node.func
+            else:
+                return node, links
+
+    def visit_chain(self, node):
+        start, links = self.chain(node)
+        required = ATOM_PRECEDENCE
+        if isinstance(start, Constant) and \
+           type(start.value) in (int, float, complex) and \
+           isinstance(links[-1], Attribute):
+            # ``1.real`` would be read as the number ``1.`` followed by a name
+            required += 1
+        self.operand(start, required)
+        for link in reversed(links):
+            if isinstance(link, Attribute):
+                self.write('.' + link.attr)
+            elif isinstance(link, Subscript):
+                self.write('[')
+                self.subscript(link.slice)
+                self.write(']')
+            else:
+                self.call_arguments(link)
+
+    visit_Attribute = visit_Call = visit_Subscript = visit_chain
+
+    def subscript(self, node):
+        if isinstance(node, Tuple) and node.elts:
+            # ``a[1:2, ::3]``, slices are only allowed without parentheses
+            for idx, item in enumerate(node.elts):
+                if idx:
+                    self.write(', ')
+                self.visit(item)
+            if len(node.elts) == 1:
+                self.write(',')
+        else:
+            self.visit(node)
 
-    def visit_Call(self, node):
+    def call_arguments(self, node):
         want_comma = []
         def write_comma():
             if want_comma:
@@ -353,38 +572,96 @@ class SourceGenerator(NodeVisitor):
             else:
                 want_comma.append(True)
 
-        self.visit(node.func)
         self.write('(')
         for arg in node.args:
             write_comma()
             self.visit(arg)
         for keyword in node.keywords:
             write_comma()
-            self.write(keyword.arg + '=')
-            self.visit(keyword.value)
-        if node.starargs is not None:
-            write_comma()
-            self.write('*')
-            self.visit(node.starargs)
-        if node.kwargs is not None:
-            write_comma()
-            self.write('**')
-            self.visit(node.kwargs)
+            self.visit(keyword)
         self.write(')')
 
     def visit_Name(self, node):
         self.write(node.id)
 
-    def visit_Str(self, node):
-        self.write(repr(node.s))
+    def visit_Constant(self, node):
+        self.write(constant_repr(node))
 
-    def visit_Bytes(self, node):
-        self.write(repr(node.s))
-
-    def visit_Num(self, node):
-        self.write(repr(node.n))
+    def visit_JoinedStr(self, node):
+        parts = self.fstring_parts(node)
+        sources = [part for raw, part in parts if raw]
+        for quote in ("'", '"', "'''", '"""'):
+            if not any(quote[0] in source for source in sources):
+                break
+        self.write('f' + quote)
+        for raw, part in parts:
+            if not raw:
+                part = string_body(part, quote).replace('{', '{{') \
+                                               .replace('}', '}}')
+            self.write(part)
+        self.write(quote)
+
+    def fstring_parts(self, node):
+        """Returns the parts of the f-string `node` as a list of
+        ``(raw, text)`` pairs, where the text of literal parts that aren't
+        raw still has to be escaped.
+        """
+        parts = []
+        for value in node.values:
+            if isinstance(value, Constant):
+                parts.append((False, value.value))
+                continue
+            # a lambda or a bare ``yield`` would swallow the closing brace
+            source = self.expression_source(value.value, PRECEDENCE[IfExp])
+            if source.startswith('{'):
+                source = ' ' + source
+            parts.append((True, '{' + source))
+            if value.conversion != -1:
+                parts.append((True, '!' + chr(value.conversion)))
+            if value.format_spec is not None:
+                parts.append((True, ':'))
+                parts.extend(self.fstring_parts(value.format_spec))
+            parts.append((True, '}'))
+        return parts
+
+    def expression_source(self, node, required=0):
+        stream = StringIO()
+        generator = SourceGenerator(self.indent_with, stream)
+        generator.operand(node, required)
+        return stream.getvalue()
+
+    def constant(self, node):
+        """Writes `node` in one go if it is a literal made up of constants
+        only and returns whether it did.
+        """
+        items = constant_items(node)
+        if items is None:
+            return False
+        left, right = container_brackets(node, items)
+        source = ', '.join(items)
+        if self.wrap_width is None or len(source) <= self.wrap_width:
+            self.write(left + source + right)
+            return True
+        indentation = self.indent_with * (self.indentation + 1)
+        lines = []
+        line = []
+        width = len(indentation)
+        for item in items:
+            if line and width + len(item) + 1 > self.wrap_width:
+                lines.append(', '.join(line))
+                line = []
+                width = len(indentation)
+            line.append(item)
+            width += len(item) + 2
+        lines.append(', '.join(line))
+        self.write('%s\n%s%s\n%s%s' % (
+            left, indentation, (',\n' + indentation).join(lines),
+            self.indent_with * self.indentation, right))
+        return True
 
     def visit_Tuple(self, node):
+        if self.constant(node):
+            return
         self.write('(')
         idx = -1
         for idx, item in enumerate(node.elts):
@@ -395,6 +672,8 @@ class SourceGenerator(NodeVisitor):
 
     def sequence_visit(left, right):
         def visit(self, node):
+            if self.constant(node):
+                return
             self.write(left)
             for idx, item in enumerate(node.elts):
                 if idx:
@@ -408,50 +687,75 @@ class SourceGenerator(NodeVisitor):
     del sequence_visit
 
     def visit_Dict(self, node):
+        if self.constant(node):
+            return
         self.write('{')
         for idx, (key, value) in enumerate(zip(node.keys, node.values)):
             if idx:
                 self.write(', ')
+            if key is None:
+                self.write('**')
+                self.operand(value, PRECEDENCE[BitOr])
+                continue
             self.visit(key)
             self.write(': ')
             self.visit(value)
         self.write('}')
 
+    def operand(self, node, required):
+        """Visits `node`, in parentheses if it binds more loosely than the
+        precedence `required` by its position.
+        """
+        if precedence(node) < required:
+            self.write('(')
+            self.visit(node)
+            self.write(')')
+        else:
+            self.visit(node)
+
+    def binop_precedences(self, node):
+        """Returns the precedence required of the left and right operand of
+        the binary operation `node`.
+        """
+        required = PRECEDENCE[type(node.op)]
+        if isinstance(node.op, Pow):
+            # right associative, and ``2 ** -1`` needs no parentheses
+            return required + 1, PRECEDENCE[USub]
+        return required, required + 1
+
     def visit_BinOp(self, node):
-        self.visit(node.left)
-        self.write(' %s ' % BINOP_SYMBOLS[type(node.op)])
-        self.visit(node.right)
+        # ``a + b + c`` nests on the left, walk down that side in a loop
+        operations = [node]
+        while isinstance(node.left, BinOp) and \
+              precedence(node.left) >= self.binop_precedences(node)[0]:
+            node = node.left
+            operations.append(node)
+        self.operand(node.left, self.binop_precedences(node)[0])
+        for operation in reversed(operations):
+            self.write(' %s ' % BINOP_SYMBOLS[type(operation.op)])
+            self.operand(operation.right,
+                         self.binop_precedences(operation)[1])
 
     def visit_BoolOp(self, node):
-        self.write('(')
+        required = PRECEDENCE[type(node.op)] + 1
         for idx, value in enumerate(node.values):
             if idx:
                 self.write(' %s ' % BOOLOP_SYMBOLS[type(node.op)])
-            self.visit(value)
-        self.write(')')
+            self.operand(value, required)
 
     def visit_Compare(self, node):
-        self.write('(')
-        self.visit(node.left)
+        required = PRECEDENCE[Compare] + 1
+        self.operand(node.left, required)
         for op, right in zip(node.ops, node.comparators):
             self.write(' %s ' % CMPOP_SYMBOLS[type(op)])
-            self.visit(right)
-        self.write(')')
+            self.operand(right, required)
 
     def visit_UnaryOp(self, node):
-        self.write('(')
         op = UNARYOP_SYMBOLS[type(node.op)]
         self.write(op)
         if op == 'not':
             self.write(' ')
-        self.visit(node.operand)
-        self.write(')')
-
-    def visit_Subscript(self, node):
-        self.visit(node.value)
-        self.write('[')
-        self.visit(node.slice)
-        self.write(']')
+        self.operand(node.operand, PRECEDENCE[type(node.op)])
 
     def visit_Slice(self, node):
         if node.lower is not None:
@@ -461,27 +765,49 @@ class SourceGenerator(NodeVisitor):
             self.visit(node.upper)
         if node.step is not None:
             self.write(':')
-            if not (isinstance(node.step, Name) and node.step.id == 'None'):
-                self.visit(node.step)
+            self.visit(node.step)
 
-    def visit_ExtSlice(self, node):
-        for idx, item in node.dims:
-            if idx:
-                self.write(', ')
-            self.visit(item)
+    def visit_Yield(self, node, parentheses=True):
+        self.write(parentheses and '(yield' or 'yield')
+        if node.value is not None:
+            self.write(' ')
+            self.visit(node.value)
+        if parentheses:
+            self.write(')')
+
+    def visit_YieldFrom(self, node, parentheses=True):
+        self.write(parentheses and '(yield from ' or 'yield from ')
+        self.visit(node.value)
+        if parentheses:
+            self.write(')')
+
+    def statement_value(self, node):
+        """Visits the expression `node` that makes up a statement or the
+        value of an assignment, where yield expressions need no parentheses.
+        """
+        if isinstance(node, Yield):
+            self.visit_Yield(node, False)
+        elif isinstance(node, YieldFrom):
+            self.visit_YieldFrom(node, False)
+        else:
+            self.visit(node)
+
+    def visit_Await(self, node):
+        self.write('await ')
+        self.operand(node.value, ATOM_PRECEDENCE)
 
-    def visit_Yield(self, node):
-        self.write('yield ')
+    def visit_NamedExpr(self, node):
+        self.write('(')
+        self.visit(node.target)
+        self.write(' := ')
         self.visit(node.value)
+        self.write(')')
 
     def visit_Lambda(self, node):
         self.write('lambda ')
         self.signature(node.args)
         self.write(': ')
-        self.visit(node.body)
-
-    def visit_Ellipsis(self, node):
-        self.write('Ellipsis')
+        self.operand(node.body, PRECEDENCE[Lambda])
 
     def generator_visit(left, right):
         def visit(self, node):
@@ -507,56 +833,143 @@ class SourceGenerator(NodeVisitor):
         self.write('}')
 
     def visit_IfExp(self, node):
-        self.write('(')
-        self.visit(node.body)
+        required = PRECEDENCE[IfExp]
+        self.operand(node.body, required + 1)
         self.write(' if ')
-        self.visit(node.test)
+        self.operand(node.test, required + 1)
         self.write(' else ')
-        self.visit(node.orelse)
-        self.write(')')
+        self.operand(node.orelse, required)
 
     def visit_Starred(self, node):
         self.write('*')
-        self.visit(node.value)
-
-    def visit_Repr(self, node):
-        self.write('`')
-        self.visit(node.value)
-        self.write('`')
+        self.operand(node.value, PRECEDENCE[BitOr])
 
     # Helper Nodes
 
+    def visit_arg(self, node):
+        self.write(node.arg)
+        if node.annotation is not None:
+            self.write(': ')
+            self.visit(node.annotation)
+
+    def visit_keyword(self, node):
+        if node.arg is None:
+            self.write('**')
+        else:
+            self.write(node.arg + '=')
+        self.visit(node.value)
+
     def visit_alias(self, node):
         self.write(node.name)
         if node.asname is not None:
             self.write(' as ' + node.asname)
 
     def visit_comprehension(self, node):
-        self.write(' for ')
+        self.write(node.is_async and ' async for ' or ' for ')
         self.visit(node.target)
         self.write(' in ')
-        self.visit(node.iter)
+        # conditional expressions need parentheses here
+        self.operand(node.iter, PRECEDENCE[IfExp] + 1)
         if node.ifs:
             for if_ in node.ifs:
                 self.write(' if ')
-                self.visit(if_)
+                self.operand(if_, PRECEDENCE[IfExp] + 1)
+
+    def visit_match_case(self, node):
+        self.newline()
+        self.write('case ')
+        self.visit(node.pattern)
+        if node.guard is not None:
+            self.write(' if ')
+            self.visit(node.guard)
+        self.write(':')
+        self.body(node.body)
 
-    def visit_excepthandler(self, node):
+    def patterns(self, patterns):
+        for idx, pattern in enumerate(patterns):
+            if idx:
+                self.write(', ')
+            self.visit(pattern)
+
+    def visit_MatchValue(self, node):
+        self.visit(node.value)
+
+    def visit_MatchSingleton(self, node):
+        self.write(repr(node.value))
+
+    def visit_MatchSequence(self, node):
+        self.write('[')
+        self.patterns(node.patterns)
+        self.write(']')
+
+    def visit_MatchStar(self, node):
+        self.write('*' + (node.name or '_'))
+
+    def visit_MatchMapping(self, node):
+        self.write('{')
+        for idx, (key, pattern) in enumerate(zip(node.keys, node.patterns)):
+            if idx:
+                self.write(', ')
+            self.visit(key)
+            self.write(': ')
+            self.visit(pattern)
+        if node.rest is not None:
+            if node.keys:
+                self.write(', ')
+            self.write('**' + node.rest)
+        self.write('}')
+
+    def visit_MatchClass(self, node):
+        self.visit(node.cls)
+        self.write('(')
+        self.patterns(node.patterns)
+        for idx, (name, pattern) in enumerate(zip(node.kwd_attrs,
+                                                  node.kwd_patterns)):
+            if idx or node.patterns:
+                self.write(', ')
+            self.write(name + '=')
+            self.visit(pattern)
+        self.write(')')
+
+    def visit_MatchAs(self, node):
+        if node.pattern is None:
+            self.write(node.name or '_')
+            return
+        if isinstance(node.pattern, MatchAs):
+            self.write('(')
+            self.visit(node.pattern)
+            self.write(')')
+        else:
+            self.visit(node.pattern)
+        self.write(' as ' + node.name)
+
+    def visit_MatchOr(self, node):
+        for idx, pattern in enumerate(node.patterns):
+            if idx:
+                self.write(' | ')
+            if isinstance(pattern, MatchOr) or \
+               isinstance(pattern, MatchAs) and pattern.pattern is not None:
+                self.write('(')
+                self.visit(pattern)
+                self.write(')')
+            else:
+                self.visit(pattern)
+
+    def visit_ExceptHandler(self, node, star=''):
         self.newline(node)
-        self.write('except')
+        self.write('except' + star)
         if node.type is not None:
             self.write(' ')
             self.visit(node.type)
             if node.name is not None:
-                self.write(' as ')
-                self.visit(node.name)
+                self.write(' as ' + node.name)
         self.write(':')
         self.body(node.body)
 
 if __name__ == '__main__':
-    import ast
     import os
     import sys
+    import frontend
     
     code2 = """
 # comment
@@ -635,22 +1048,19 @@ class NameFlash_AppDelegate(NSObject):
     #print round1 == round2
     
     if len(sys.argv) != 2:
-        print "Syntax: codegen <input.py>"
+        print("Syntax: codegen <input.py>")
         sys.exit(1)
 
     input_filename = sys.argv[1]
     pathname = os.getcwd() + "/" + input_filename
 
-    # Pre-processing comments
-    lines = []
     with open(pathname, 'r') as f:
-        for line in f.readlines():
-            if line.strip().startswith('#'):
-                lines.append(line.replace('"', '\\"').replace('#', '__comment__ = "', 1)[:-1]+'"\n')
-            else:
-                lines.append(line)
-    code = ''.join(lines)
+        source = f.read()
 
-    node = ast.parse(code)
-
-    print to_source(node)
\ No newline at end of file
+    cache_directory = os.environ.get('CODEGEN_CACHE_DIR')
+    if cache_directory:
+        import codegen
+        from codegen_cache import OutputCache
+        print(OutputCache(cache_directory).translate(source, codegen))
+    else:
+        print(to_source(frontend.parse(source, input_filename)))
\ No newline at end of file
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    codegen_cache
+    ~~~~~~~~~~~~~
+
+    Content-addressed on-disk cache of code generator outputs.
+
+    An output is stored under the hash of the input source, the version of
+    the generator (the hash of its own source and that of its operator
+    mapping) and the `to_source` options, so a cached output is only used if
+    translating again would produce the same result.  When the cache grows
+    beyond its size limit the least recently used outputs are removed.
+
+    The `codegen` and `codegen_objc` command line drivers use the cache in
+    the directory given by the `CODEGEN_CACHE_DIR` environment variable.
+
+    :license: BSD, see LICENSE for more details.
+"""
+import hashlib
+import os
+import tempfile
+
+import frontend
+
+
+CACHE_DIRECTORY_ENVIRONMENT_VARIABLE = 'CODEGEN_CACHE_DIR'
+
+# The modules whose source makes up the version of a generator module.
+# `frontend` pre-processes the comments of every input, and `optimize` runs
+# on it with the `optimize` option.
+GENERATOR_SOURCES = {
+    'codegen':          ('codegen', 'mapping', 'frontend', 'optimize'),
+    'codegen_objc':     ('codegen_objc', 'mapping_objc', 'frontend',
+                         'optimize', 'mapping')
+}
+
+_versions = {}
+
+
+def generator_version(generator):
+    """Returns the hash of the source code the generator module `generator`
+    is made of.
+    """
+    name = generator.__name__
+    if name not in _versions:
+        digest = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(generator.__file__))
+        for source_name in GENERATOR_SOURCES.get(name, (name,)):
+            with open(os.path.join(directory, source_name + '.py'), 'rb') as f:
+                digest.update(f.read())
+        _versions[name] = digest.hexdigest()
+    return _versions[name]
+
+
+class OutputCache(object):
+    """Cache of generator outputs in `directory`, which keeps its size
+    below roughly `max_size` bytes.
+    """
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum(size for pathname, size, mtime in self.entries())
+
+    def key(self, source, generator, options):
+        digest = hashlib.sha1()
+        for part in (generator.__name__, generator_version(generator),
+                     repr(sorted(options.items())), source):
+            digest.update(part.encode('utf-8') + b'\0')
+        return digest.hexdigest()
+
+    def pathname(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def entries(self):
+        """Yields the path, size and modification time of every output."""
+        for directory, directories, filenames in os.walk(self.directory):
+            for filename in filenames:
+                pathname = os.path.join(directory, filename)
+                try:
+                    st = os.stat(pathname)
+                except OSError:
+                    continue
+                yield pathname, st.st_size, st.st_mtime
+
+    def get(self, key):
+        """Returns the output stored under `key` or `None`."""
+        pathname = self.pathname(key)
+        try:
+            with open(pathname, 'rb') as f:
+                output = f.read().decode('utf-8')
+            # the modification time is the time of the last use
+            os.utime(pathname, None)
+        except (IOError, OSError):
+            return None
+        return output
+
+    def put(self, key, output):
+        pathname = self.pathname(key)
+        directory = os.path.dirname(pathname)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                pass
+        # write to a temporary file first, so readers never see half of it
+        data = output.encode('utf-8')
+        fd, temporary = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            # an output stored under `key` before is replaced
+            self.size -= os.stat(pathname).st_size
+        except OSError:
+            pass
+        os.rename(temporary, pathname)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used outputs until the cache is down to
+        three quarters of its maximum size.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for pathname, size, mtime in entries)
+        for pathname, size, mtime in entries:
+            if self.size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.unlink(pathname)
+            except OSError:
+                continue
+            self.size -= size
+
+    def translate(self, source, generator, store=None, **options):
+        """Returns the output of the generator module `generator` for the
+        Python code `source`, translating it only if it isn't cached yet.
+        The source is parsed with the `frontend.ASTStore` `store` if given.
+        """
+        key = self.key(source, generator, options)
+        output = self.get(key)
+        if output is None:
+            if store is not None:
+                tree = store.parse(source)
+            else:
+                tree = frontend.parse(source)
+            output = frontend.render(tree, generator, **options)
+            self.put(key, output)
+        return output
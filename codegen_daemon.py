@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+    codegen_daemon
+    ~~~~~~~~~~~~~~
+
+    Translation daemon that keeps the code generators loaded and recently
+    parsed sources cached, so that editor integrations don't pay for
+    starting an interpreter on every request.
+
+        python codegen_daemon.py serve SOCKET [--workers N] [--cache DIR]
+        python codegen_daemon.py translate SOCKET objc|python FILE [--optimize]
+
+    Clients talk to the daemon over the Unix domain socket `SOCKET`.  Every
+    request is a JSON object on a line of its own and gets a JSON object on
+    a line of its own back::
+
+        {"id": 1, "command": "translate", "generator": "objc",
+         "source": "...", "options": {"indent_with": "  "}}
+        {"id": 1, "ok": true, "output": "..."}
+
+    The commands are `translate` (with `generator` either `objc` or
+    `python`), `reformat` (the same as translating with `python`) and
+    `ping`.  Failed requests get ``"ok": false`` and an `error` message.
+
+    :license: BSD, see LICENSE for more details.
+"""
+import asyncio
+import errno
+import json
+import os
+import socket
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+import codegen
+import codegen_objc
+from codegen_cache import OutputCache
+from frontend import ASTStore, render
+
+
+GENERATORS = {
+    'objc':     codegen_objc,
+    'python':   codegen
+}
+
+# The `to_source` arguments clients may set, per generator.
+OPTIONS = {
+    'objc':     ('indent_with', 'add_line_information',
+                 'autorelease_threshold', 'optimize'),
+    'python':   ('indent_with', 'add_line_information', 'wrap_width',
+                 'compact', 'strip_docstrings', 'strip_comments', 'optimize')
+}
+
+# The longest request line the daemon reads, in bytes.
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+
+class Translator(object):
+    """Handles requests, translating at most `workers` sources at the same
+    time on threads of their own.
+    """
+
+    def __init__(self, workers=4, cache_entries=256, output_cache=None):
+        self.executor = ThreadPoolExecutor(workers)
+        self.trees = ASTStore(cache_entries)
+        self.output_cache = output_cache
+
+    def translate(self, source, generator, options):
+        if generator not in GENERATORS:
+            raise ValueError('unknown generator %r' % generator)
+        for name in options:
+            if name not in OPTIONS[generator]:
+                raise ValueError('unknown option %r for the %s generator' %
+                                 (name, generator))
+        if self.output_cache is not None:
+            key = self.output_cache.key(source, GENERATORS[generator], options)
+            output = self.output_cache.get(key)
+            if output is not None:
+                return output
+        tree = self.trees.parse(source)
+        output = render(tree, GENERATORS[generator], **options)
+        if self.output_cache is not None:
+            self.output_cache.put(key, output)
+        return output
+
+    async def handle(self, message):
+        """Returns the response to the request `message`."""
+        response = {'id': message.get('id')}
+        try:
+            command = message.get('command')
+            if command == 'ping':
+                pass
+            elif command in ('translate', 'reformat'):
+                generator = message.get('generator', 'objc')
+                if command == 'reformat':
+                    generator = 'python'
+                loop = asyncio.get_running_loop()
+                response['output'] = await loop.run_in_executor(
+                    self.executor, self.translate, message['source'],
+                    generator, message.get('options', {}))
+            else:
+                raise ValueError('unknown command %r' % command)
+        except Exception as e:
+            response['ok'] = False
+            response['error'] = '%s: %s' % (e.__class__.__name__, e)
+        else:
+            response['ok'] = True
+        return response
+
+
+def remove_stale_socket(path):
+    """Removes the socket at `path` if nobody listens on it anymore.  Raises
+    `OSError` if `path` is something else or a daemon still uses it.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise OSError(errno.EEXIST, '%s exists and is not a socket' % path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, 'a daemon is listening on %s' % path)
+
+
+class Server(object):
+    """Serves the connections to the Unix domain socket `socket_path` from
+    one event loop.  Requests on one connection are answered in order.
+    """
+
+    def __init__(self, socket_path, translator):
+        self.socket_path = socket_path
+        self.translator = translator
+        # device and inode of the socket this server created
+        self.socket_id = None
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError('request is not an object')
+                except ValueError as e:
+                    response = {'id': None, 'ok': False,
+                                'error': 'ValueError: %s' % e}
+                else:
+                    response = await self.translator.handle(message)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        remove_stale_socket(self.socket_path)
+        server = await asyncio.start_unix_server(
+            self.handle_connection, self.socket_path, limit=MAX_REQUEST_SIZE)
+        st = os.stat(self.socket_path)
+        self.socket_id = (st.st_dev, st.st_ino)
+        async with server:
+            await server.serve_forever()
+
+    def server_close(self):
+        """Removes the socket, unless another daemon has replaced it."""
+        if self.socket_id is None:
+            return
+        try:
+            st = os.stat(self.socket_path)
+        except FileNotFoundError:
+            return
+        if (st.st_dev, st.st_ino) == self.socket_id:
+            os.unlink(self.socket_path)
+        self.socket_id = None
+
+
+def request(socket_path, message):
+    """Sends the request `message` to the daemon and returns its response."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        stream = connection.makefile('rw', encoding='utf-8')
+        stream.write(json.dumps(message) + '\n')
+        stream.flush()
+        return json.loads(stream.readline())
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Translation daemon.')
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='run the daemon')
+    serve.add_argument('socket')
+    serve.add_argument('--workers', type=int, default=4)
+    serve.add_argument('--cache', metavar='DIR',
+                       help='keep the outputs in an on-disk cache in DIR')
+    translate = commands.add_parser('translate',
+                                    help='translate a file with the daemon')
+    translate.add_argument('socket')
+    translate.add_argument('generator', choices=sorted(GENERATORS))
+    translate.add_argument('filename')
+    translate.add_argument('--optimize', action='store_true',
+                           help='fold constants and drop dead code first')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        output_cache = None
+        if args.cache:
+            output_cache = OutputCache(args.cache)
+        server = Server(args.socket, Translator(args.workers,
+                                                output_cache=output_cache))
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            sys.exit('%s: %s' % (args.socket, e.strerror or e))
+        finally:
+            server.server_close()
+    else:
+        with open(args.filename, 'r', encoding='utf-8') as f:
+            source = f.read()
+        response = request(args.socket, {'command': 'translate',
+                                         'generator': args.generator,
+                                         'source': source,
+                                         'options': {
+                                             'optimize': args.optimize}})
+        if not response['ok']:
+            sys.stderr.write(response['error'] + '\n')
+            sys.exit(1)
+        print(response['output'])
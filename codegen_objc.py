@@ -11,14 +11,25 @@
     :copyright: Copyright 2012 by Jan Weiß.
     :license: BSD, see LICENSE for more details.
 """
-from StringIO import StringIO
-from ast import NodeVisitor, If, Name, Pass
-from _ast import Call
-from mapping import BOOLOP_SYMBOLS, BINOP_SYMBOLS, UNARYOP_SYMBOLS, \
-     CMPOP_SYMBOLS
-
-
-def to_source(node, indent_with=' ' * 4, add_line_information=False):
+import os
+import re
+import sys
+from copy import deepcopy
+from io import StringIO
+from collections import deque
+from ast import NodeVisitor, If, Name, Pass, Assign, AugAssign, Attribute, \
+     Constant, JoinedStr, Dict, For, While, Break, Return, Global, Nonlocal, \
+     Load, Store, Del, FunctionDef, ClassDef, Lambda, Yield, YieldFrom, \
+     Await, In, NotIn, List, Tuple, Set, BinOp, Add, Sub, Mult, Mod, \
+     UnaryOp, USub, Subscript, Slice, Starred, Compare, Or, IfExp, Call, \
+     Expr, comprehension, walk, iter_fields, unparse, dump as ast_dump
+from optimize import optimize as optimize_tree
+from mapping_objc import BOOLOP_SYMBOLS, BINOP_SYMBOLS, UNARYOP_SYMBOLS, \
+     CMPOP_SYMBOLS, PRECEDENCE, ATOM_PRECEDENCE, precedence
+
+
+def to_source(node, indent_with=' ' * 4, add_line_information=False,
+              autorelease_threshold=1, profiler=None, optimize=False):
     """This function can convert a node tree back into python sourcecode.
     This is useful for debugging purposes, especially if you're dealing with
     custom asts not generated by python itself.
@@ -35,16 +46,69 @@ def to_source(node, indent_with=' ' * 4, add_line_information=False):
     If `add_line_information` is set to `True` comments for the line numbers
     of the nodes are added to the output.  This can be used to spot wrong line
     number information of statement nodes.
+
+    Loops whose body creates at least `autorelease_threshold` objects have
+    each iteration wrapped in an `@autoreleasepool`.  Set it to `None` to
+    only do that for loops marked with the `autoreleasepool` pragma.
+
+    If a `profiling.Profiler` is passed as `profiler` the time spent on
+    every node type and `visit_*` method is recorded in it.
+
+    If `optimize` is set to `True` a copy of the tree is run through
+    `optimize.optimize` first, which folds constants and drops dead code.
+    """
+    generator, lines = generate(node, indent_with, add_line_information,
+                                autorelease_threshold, profiler, optimize)
+    return interface_source(generator) + \
+           static_functions_source(generator, indent_with) + '\n'.join(lines)
+
+
+def to_files(node, module_name, indent_with=' ' * 4,
+             add_line_information=False, autorelease_threshold=1,
+             profiler=None, root=None, optimize=False):
+    """Like `to_source`, but returns the header and the implementation file
+    of the module `module_name` separately.
+
+    The header only imports the headers of superclasses from other modules
+    and declares every other class its properties refer to with `@class`,
+    so changing a module only rebuilds the files that really depend on it.
+    The implementation file imports the headers of all modules the Python
+    code imports from.
+
+    Only the modules of the project get a header of their own.  These are
+    relative imports, modules of the package of `module_name` and, if the
+    directory `root` of the project is given, the modules found below it.
+    PyObjC framework packages import the umbrella header of the framework
+    and every other module (the standard library, third-party packages) is
+    left out.
     """
+    generator, lines = generate(node, indent_with, add_line_information,
+                                autorelease_threshold, profiler, optimize)
+    header = header_imports_source(generator, module_name, root) + \
+             interface_source(generator)
+    implementation = implementation_imports_source(generator, module_name,
+                                                   root) + \
+                     static_functions_source(generator, indent_with) + \
+                     '\n'.join(lines)
+    return header, implementation
+
+
+def generate(node, indent_with, add_line_information, autorelease_threshold,
+             profiler, optimize=False):
+    """Visits `node` and returns the generator and the lines it wrote."""
+    if optimize:
+        node = optimize_tree(deepcopy(node))
     out = StringIO()
-    generator = SourceGenerator(indent_with, out, add_line_information)
+    generator = SourceGenerator(indent_with, out, add_line_information,
+                                autorelease_threshold)
+    if profiler is not None:
+        profiler.instrument(generator)
     generator.visit(node)
     
     lines = out.getvalue().split('\n')
-    out.truncate(0)
     
     # Post-processing comments
-    for i in xrange(len(lines)):
+    for i in range(len(lines)):
         line = lines[i]
 
         if line.strip().startswith('__comment__ = @"'):
@@ -56,26 +120,225 @@ def to_source(node, indent_with=' ' * 4, add_line_information=False):
 
         lines[i] = line
 
+    return generator, lines
 
-    for key, attribs in generator.classAttributes.items():
-        out.write('@interface %s {' % key)
+
+def interface_source(generator):
+    out = StringIO()
+    for class_name, attribs in generator.classAttributes.items():
+        types = generator.classAttributeTypes.get(class_name, {})
+        out.write('@interface %s' % class_name)
+        if class_name in generator.classSuperclasses:
+            out.write(' : %s' % generator.classSuperclasses[class_name])
+        out.write('\n\n')
         for v in sorted(attribs):
-            t = 'id'
-            if v in generator.currentClassAttributeTypes:
-                t = generator.currentClassAttributeTypes[v]
-            out.write('%s%s %s;' % (indent_with, t, v))
-        out.write('}')
+            t = types.get(v, 'id')
+            out.write('@property (%s) %s;\n' % (property_attributes(t),
+                                                declaration(t, v)))
         out.write('\n@end\n\n')
-    
-    interface = out.getvalue()
-    
-    return interface + '\n'.join(lines)
+    return out.getvalue()
+
+
+def static_functions_source(generator, indent_with):
+    out = StringIO()
+    for name, elements in generator.membership_sets:
+        out.write('static NSSet *%s(void) {\n' % name)
+        out.write('%sstatic NSSet *set;\n' % indent_with)
+        out.write('%sstatic dispatch_once_t once;\n' % indent_with)
+        out.write('%sdispatch_once(&once, ^{\n' % indent_with)
+        out.write('%sset = [NSSet setWithObjects:%s, nil];\n' %
+                  (indent_with * 2, ', '.join(elements)))
+        out.write('%s});\n' % indent_with)
+        out.write('%sreturn set;\n' % indent_with)
+        out.write('}\n\n')
+    for name, source in SLICE_FUNCTIONS:
+        if name in generator.slice_functions:
+            out.write(source.replace('\t', indent_with))
+            out.write('\n')
+    return out.getvalue()
+
+
+def header_imports_source(generator, module_name, root=None):
+    """Returns the imports and forward declarations of the header of
+    `module_name`.  A superclass has to be complete where a subclass is
+    declared, but a pointer to a class only needs the class name.
+    """
+    declared = set()
+    headers = [FOUNDATION_HEADER]
+    forward = set()
+    for class_name in generator.classAttributes:
+        declared.add(class_name)
+        superclass = generator.classSuperclasses.get(class_name)
+        if superclass in generator.imported_classes:
+            header = module_header(module_name, root,
+                                   *generator.imported_classes[superclass])
+            if header is not None and header not in headers:
+                headers.append(header)
+        types = generator.classAttributeTypes.get(class_name, {})
+        for objc_type in types.values():
+            pointee = pointer_class(objc_type)
+            if pointee is not None and pointee not in declared and \
+               not pointee.startswith(FOUNDATION_PREFIX):
+                forward.add(pointee)
+    for class_name in list(forward):
+        # classes of the imported headers are complete already
+        if class_name in generator.imported_classes and \
+           module_header(module_name, root,
+                         *generator.imported_classes[class_name]) in headers:
+            forward.discard(class_name)
+    out = StringIO()
+    for header in headers:
+        out.write('#import %s\n' % header)
+    out.write('\n')
+    if forward:
+        out.write('@class %s;\n\n' % ', '.join(sorted(forward)))
+    return out.getvalue()
+
+
+def implementation_imports_source(generator, module_name, root=None):
+    headers = ['"%s"' % header_filename(module_name)]
+    for level, module in generator.imported_modules:
+        header = module_header(module_name, root, level, module)
+        if header is not None and header not in headers:
+            headers.append(header)
+    return ''.join('#import %s\n' % header for header in headers) + '\n'
+
+
+# Loop pragmas.  These are either given as a decorator on the enclosing
+# function (``@imp_cache``), which applies them to every loop in it, or as
+# a comment on the line right before a single loop (``# imp_cache`` or
+# ``# pragma: imp_cache``).  `imp_cache` calls the cached methods through
+# ``id (*)(id, SEL, id, ...)`` pointers, so it may only be used on loops
+# whose message sends take and return objects.
+PRAGMAS = ('imp_cache', 'autoreleasepool', 'no_autoreleasepool', 'parallel')
+
+# Fields of compound statements that hold statements rather than
+# expressions.
+BLOCK_FIELDS = ('body', 'orelse', 'finalbody', 'handlers', 'cases')
+
+# The queue the iterations of `parallel` loops are dispatched to.
+PARALLEL_QUEUE = 'dispatch_get_global_queue(DISPATCH_QUEUE_PRIORITY_DEFAULT, 0)'
+
+# Classes with this prefix are declared by `<Foundation/Foundation.h>`.
+FOUNDATION_PREFIX = 'NS'
+FOUNDATION_HEADER = '<Foundation/Foundation.h>'
+
+# PyObjC packages that wrap the framework of the same name.  Importing them
+# imports the umbrella header of the framework.
+FRAMEWORKS = frozenset(['AddressBook', 'AppKit', 'AVFoundation', 'Cocoa',
+                        'CoreData', 'CoreFoundation', 'CoreGraphics',
+                        'CoreLocation', 'CoreText', 'Foundation', 'GameKit',
+                        'MapKit', 'Quartz', 'QuartzCore', 'ScriptingBridge',
+                        'UIKit', 'WebKit'])
+
+# Selectors that always create a new object.
+ALLOCATING_SELECTORS = ('alloc', 'new', 'copy', 'mutableCopy')
+
+# Attribute types that have mutable subclasses and are therefore declared as
+# `copy` properties.
+COPY_TYPES = ('NSString *', 'NSArray *', 'NSDictionary *')
+
+# Types whose `+`, `%` and `join` are lowered to `NSString` messages.
+STRING_TYPES = ('NSString *', 'NSMutableString *')
+
+# Scalar types, which are formatted with the C conversions instead of `%@`.
+INTEGER_TYPES = ('int', 'BOOL', 'NSInteger', 'NSUInteger', 'long')
+FLOAT_TYPES = ('float', 'double', 'CGFloat')
+LENGTH_MODIFIERS = {'NSInteger': 'l', 'NSUInteger': 'l', 'long': 'l'}
+
+# A conversion specifier of Python's `%` formatting.
+FORMAT_SPECIFIER = re.compile(r'%(?P<flags>[-+ #0]*)(?P<width>\d*)'
+                              r'(?:\.(?P<precision>\d+))?(?P<conversion>.?)',
+                              re.S)
+
+# A format spec of an f-string replacement field that printf can express.
+FORMAT_SPEC = re.compile(r'(?P<flags>[+ #0]*)(?P<width>\d*)'
+                         r'(?:\.(?P<precision>\d+))?'
+                         r'(?P<conversion>[dxXoeEfFgGs]?)$')
+
+
+# Static functions with Python's slice semantics, written in this order if
+# they are used.  `NSNotFound` stands for a bound that is left out.
+SLICE_FUNCTIONS = (
+    ('_sliceRange', '''\
+static NSRange _sliceRange(NSInteger length, NSInteger start, NSInteger stop) {
+\tif (start == NSNotFound) {
+\t\tstart = 0;
+\t} else if (start < 0) {
+\t\tstart = MAX(start + length, 0);
+\t} else {
+\t\tstart = MIN(start, length);
+\t}
+\tif (stop == NSNotFound) {
+\t\tstop = length;
+\t} else if (stop < 0) {
+\t\tstop = MAX(stop + length, 0);
+\t} else {
+\t\tstop = MIN(stop, length);
+\t}
+\treturn NSMakeRange(start, MAX(stop - start, 0));
+}
+'''),
+    ('_sliceIndices', '''\
+static NSInteger _sliceIndices(NSInteger length, NSInteger *start, NSInteger *stop, NSInteger step) {
+\tNSCAssert(step != 0, @"slice step cannot be zero");
+\tNSInteger lower = step < 0 ? -1 : 0;
+\tNSInteger upper = step < 0 ? length - 1 : length;
+\tif (*start == NSNotFound) {
+\t\t*start = step < 0 ? upper : lower;
+\t} else if (*start < 0) {
+\t\t*start = MAX(*start + length, lower);
+\t} else {
+\t\t*start = MIN(*start, upper);
+\t}
+\tif (*stop == NSNotFound) {
+\t\t*stop = step < 0 ? lower : upper;
+\t} else if (*stop < 0) {
+\t\t*stop = MAX(*stop + length, lower);
+\t} else {
+\t\t*stop = MIN(*stop, upper);
+\t}
+\tif (step < 0) {
+\t\treturn *stop < *start ? (*start - *stop - 1) / -step + 1 : 0;
+\t}
+\treturn *start < *stop ? (*stop - *start - 1) / step + 1 : 0;
+}
+'''),
+    ('_slice', '''\
+static id _slice(id sequence, NSInteger start, NSInteger stop, NSInteger step) {
+\tBOOL isString = [sequence isKindOfClass:[NSString class]];
+\tNSInteger length = isString ? [sequence length] : [sequence count];
+\tNSInteger count = _sliceIndices(length, &start, &stop, step);
+\tif (step == 1) {
+\t\tNSRange range = NSMakeRange(start, count);
+\t\tif (isString) {
+\t\t\treturn [sequence substringWithRange:range];
+\t\t}
+\t\treturn [sequence subarrayWithRange:range];
+\t}
+\tif (isString) {
+\t\tNSMutableString *result = [NSMutableString stringWithCapacity:count];
+\t\tfor (NSInteger i = 0; i < count; i++) {
+\t\t\t[result appendFormat:@"%C", [sequence characterAtIndex:start + i * step]];
+\t\t}
+\t\treturn result;
+\t}
+\tNSMutableArray *result = [NSMutableArray arrayWithCapacity:count];
+\tfor (NSInteger i = 0; i < count; i++) {
+\t\t[result addObject:[sequence objectAtIndex:start + i * step]];
+\t}
+\treturn result;
+}
+'''),
+)
 
 
 # Utilities
 
 def id_string(arg):
-    if hasattr(arg, 'id'):
+    if hasattr(arg, 'arg'):
+        id = arg.arg
+    elif hasattr(arg, 'id'):
         id = arg.id
     elif hasattr(arg, 'elts'):
         ids = []
@@ -94,6 +357,469 @@ def capitalize_first(s):
     else:
         return s
 
+def string_literal(s):
+    return '@"%s"' % s.replace('\n', '\\n')
+
+def constant_literal(node):
+    """Returns the Objective-C object literal for a constant expression, or
+    `None` if `node` is not constant.  Capitalized names (``NSFooKey``,
+    ``kFoo``, ``FOO``) are taken to be constants.
+    """
+    if isinstance(node, Constant):
+        if node.value is True:
+            return '@YES'
+        elif node.value is False:
+            return '@NO'
+        elif node.value is None:
+            # `nil` would end the argument list of `setWithObjects:`
+            return '[NSNull null]'
+        elif isinstance(node.value, str):
+            return string_literal(node.value)
+        elif isinstance(node.value, (int, float)):
+            return '@%r' % node.value
+    elif isinstance(node, Name):
+        if node.id[:1].isupper() or re.match(r'k[A-Z]', node.id):
+            return node.id
+    return None
+
+def dotted_name(node):
+    """Returns the dotted name ``a.b.c`` the attribute chain `node` spells,
+    or `None` if it is something else.
+    """
+    names = []
+    while isinstance(node, Attribute):
+        names.append(node.attr)
+        node = node.value
+    if not isinstance(node, Name):
+        return None
+    names.append(node.id)
+    return '.'.join(reversed(names))
+
+def literal_elements(node):
+    """Returns the elements (or keys) of the literal container `node`, or
+    `None` if it is something else or unpacks other containers.
+    """
+    if isinstance(node, Dict):
+        elements = node.keys
+    elif isinstance(node, (List, Tuple, Set)):
+        elements = node.elts
+    else:
+        return None
+    for element in elements:
+        if element is None or isinstance(element, Starred):
+            return None
+    return elements
+
+def infer_type(value):
+    """Guesses the Objective-C type of a class attribute from the value it
+    is initialized with.  Returns `None` if there is no good guess.
+    """
+    if isinstance(value, Call):
+        if isinstance(value.func, Name) and value.func.id[:1].isupper():
+            # instantiation of a class
+            return '%s *' % value.func.id
+        return 'id'
+    elif isinstance(value, Dict):
+        return 'NSDictionary *'
+    elif hasattr(value, 'elts'):
+        # this attribute is a list!
+        return 'NSArray *'
+    elif isinstance(value, Constant):
+        if isinstance(value.value, bool):
+            return 'BOOL'
+        elif isinstance(value.value, (int, float, complex)):
+            # this attribute is a number!
+            return type(value.value).__name__
+        elif isinstance(value.value, str):
+            # this attribute is a string!
+            return 'NSString *'
+    return None
+
+def format_specifier(flags, width, precision, conversion, objc_type):
+    """Translates a conversion of Python's string formatting for an argument
+    of type `objc_type`.  Returns the Objective-C format specifier and the
+    text to write before and after the argument, or `None` if there is no
+    equivalent.
+    """
+    specifier = '%' + flags + width
+    if precision is not None:
+        specifier += '.' + precision
+    if conversion in ('s', 'r', 'a'):
+        if objc_type in INTEGER_TYPES:
+            return specifier + LENGTH_MODIFIERS.get(objc_type, '') + 'd', '', ''
+        elif objc_type in FLOAT_TYPES:
+            return specifier + 'g', '', ''
+        elif specifier == '%':
+            # `%@` can't be padded or truncated
+            return '%@', '', ''
+    elif conversion in ('d', 'i', 'u', 'o', 'x', 'X'):
+        if conversion in ('i', 'u'):
+            conversion = 'd'
+        if objc_type in INTEGER_TYPES:
+            return specifier + LENGTH_MODIFIERS.get(objc_type, '') + \
+                   conversion, '', ''
+        elif objc_type in FLOAT_TYPES:
+            return specifier + 'l' + conversion, '(long)', ''
+        return specifier + 'l' + conversion, '[', ' longValue]'
+    elif conversion in ('e', 'E', 'f', 'F', 'g', 'G'):
+        if objc_type in INTEGER_TYPES:
+            return specifier + conversion, '(double)', ''
+        elif objc_type in FLOAT_TYPES:
+            return specifier + conversion, '', ''
+        return specifier + conversion, '[', ' doubleValue]'
+    return None
+
+def addition_operands(node):
+    """Returns the operands of the chain of additions ``a + b + c`` `node`,
+    leftmost first.
+    """
+    operands = []
+    while isinstance(node, BinOp) and isinstance(node.op, Add):
+        operands.append(node.right)
+        node = node.left
+    operands.append(node)
+    operands.reverse()
+    return operands
+
+def string_append(stmt):
+    """Returns the target and the appended operands if `stmt` appends to a
+    variable (``s += x`` or ``s = s + x + y``), or `None`.
+    """
+    if isinstance(stmt, AugAssign) and isinstance(stmt.op, Add) and \
+       isinstance(stmt.target, Name):
+        return stmt.target, [stmt.value]
+    elif isinstance(stmt, Assign) and len(stmt.targets) == 1 and \
+         isinstance(stmt.targets[0], Name):
+        target = stmt.targets[0]
+        operands = addition_operands(stmt.value)
+        if len(operands) > 1 and isinstance(operands[0], Name) and \
+           operands[0].id == target.id:
+            return target, operands[1:]
+    return None
+
+def is_slice(node):
+    """Checks if `node` reads a slice (``a[1:n]``) of a sequence."""
+    return isinstance(node, Subscript) and isinstance(node.slice, Slice) and \
+           isinstance(node.ctx, Load)
+
+def has_step(node):
+    """Checks if the `Slice` `node` has a step other than 1."""
+    return node.step is not None and \
+           not (isinstance(node.step, Constant) and node.step.value in (None, 1))
+
+def is_simple(expr):
+    """Checks if `expr` is a constant, a name or an attribute chain
+    (``self.items``), which can be evaluated twice.
+    """
+    while isinstance(expr, Attribute):
+        expr = expr.value
+    return isinstance(expr, (Name, Constant))
+
+def int_constant(node):
+    """Returns the value of an integer literal such as ``2`` or ``-1``, or
+    `None` if `node` is something else.
+    """
+    sign = 1
+    if isinstance(node, UnaryOp) and isinstance(node.op, USub):
+        sign, node = -1, node.operand
+    if isinstance(node, Constant) and type(node.value) is int:
+        return sign * node.value
+    return None
+
+def is_range_call(node):
+    return isinstance(node, Call) and isinstance(node.func, Name) and \
+           node.func.id == 'range' and 1 <= len(node.args) <= 3 and \
+           not node.keywords and \
+           not any(isinstance(arg, Starred) for arg in node.args)
+
+def range_step(node):
+    """Returns the step of the `range` call `node`, or `None` if it isn't
+    a constant.
+    """
+    if len(node.args) < 3:
+        return 1
+    return int_constant(node.args[2])
+
+def stored_names(statements):
+    """Yields the names that `statements` assign to or delete, leaving out
+    the variables of comprehensions, which have a scope of their own.
+    """
+    nodes = list(loop_nodes(statements))
+    comprehension_targets = set()
+    for node in nodes:
+        if isinstance(node, comprehension):
+            comprehension_targets.update(walk(node.target))
+    for node in nodes:
+        if isinstance(node, Name) and isinstance(node.ctx, (Store, Del)) and \
+           node not in comprehension_targets:
+            yield node.id
+        elif isinstance(node, (FunctionDef, ClassDef)):
+            yield node.name
+
+def read_names(nodes):
+    """Yields the names `nodes` read, including the targets of augmented
+    assignments.
+    """
+    for node in loop_nodes(nodes):
+        if isinstance(node, Name) and isinstance(node.ctx, Load):
+            yield node.id
+        elif isinstance(node, AugAssign) and isinstance(node.target, Name):
+            yield node.target.id
+
+def read_before_assignment(statements, assigned, names):
+    """Returns the first of `names` that `statements` read before they
+    assign it on every path to the read, or `None`.  `assigned` is the set
+    of names assigned already; the names `statements` assign on every path
+    are added to it.
+    """
+    for stmt in statements:
+        blocks = [field for field in BLOCK_FIELDS if hasattr(stmt, field)]
+        if not blocks or isinstance(stmt, (FunctionDef, ClassDef)):
+            for name in sorted(set(read_names([stmt])) & names - assigned):
+                return name
+            assigned.update(stored_names([stmt]))
+            continue
+        header = []
+        for field, value in iter_fields(stmt):
+            if field not in blocks:
+                header.extend(value if isinstance(value, list) else [value])
+        header = [node for node in header if hasattr(node, '_fields')]
+        for name in sorted(set(read_names(header)) & names - assigned):
+            return name
+        # the loop variable is only assigned if the loop runs at all
+        bound = set(stored_names(header))
+        if isinstance(stmt, For):
+            always = bound - set(stored_names([stmt.target]))
+        else:
+            always = bound
+        results = {}
+        for field in blocks:
+            if field == 'orelse' and 'handlers' in blocks:
+                # the else clause of try runs after the body completed
+                block_assigned = set(results['body'])
+            else:
+                block_assigned = assigned | bound
+            name = read_before_assignment(getattr(stmt, field),
+                                          block_assigned, names)
+            if name is not None:
+                return name
+            results[field] = block_assigned
+        assigned.update(always)
+        if isinstance(stmt, If):
+            assigned.update(results['body'] & results['orelse'])
+        elif 'items' in stmt._fields:
+            # with statements always run their body
+            assigned.update(results['body'])
+    return None
+
+def statement_path(owner, statements, node):
+    """Returns the blocks that lead to the statement `node` in the block
+    `statements` of `owner`, outermost first, as ``(owner, block, index)``
+    tuples with the position of the next statement on the way in the block.
+    Returns `None` if `node` isn't there.
+    """
+    for index, stmt in enumerate(statements):
+        if stmt is node:
+            return [(owner, statements, index)]
+        if isinstance(stmt, (FunctionDef, ClassDef)):
+            continue
+        for field in BLOCK_FIELDS:
+            path = statement_path(stmt, getattr(stmt, field, ()), node)
+            if path is not None:
+                return [(owner, statements, index)] + path
+    return None
+
+def statements_after(path):
+    """Returns the statements that may run after the statement at the end
+    of `path` (see `statement_path`), in order.  The body of an enclosing
+    loop runs again, and the handlers of an enclosing ``try`` may run.
+    """
+    statements = []
+    for owner, block, index in reversed(path):
+        statements.extend(block[index + 1:])
+        if isinstance(owner, (For, While)) and block is owner.body:
+            if isinstance(owner, While):
+                statements.append(Expr(value=owner.test))
+            statements.extend(owner.body)
+            statements.extend(owner.orelse)
+        elif hasattr(owner, 'handlers'):
+            if block is owner.body:
+                statements.extend(owner.handlers)
+                statements.extend(owner.orelse)
+            elif block is owner.handlers:
+                statements.extend(owner.orelse)
+            if block is not owner.finalbody:
+                statements.extend(owner.finalbody)
+    return statements
+
+def property_attributes(objc_type):
+    """Returns the attributes of the `@property` declaration for an
+    attribute of type `objc_type`.
+    """
+    if objc_type in COPY_TYPES:
+        ownership = 'copy'
+    elif objc_type == 'id' or objc_type.endswith('*'):
+        ownership = 'strong'
+    else:
+        ownership = 'assign'
+    return 'nonatomic, %s' % ownership
+
+def pointer_class(objc_type):
+    """Returns the class `objc_type` points to, e.g. ``Foo`` for ``Foo *``,
+    or `None` if it's not a pointer to a class.
+    """
+    if objc_type.endswith(' *'):
+        return objc_type[:-len(' *')]
+    return None
+
+def header_filename(module):
+    """Returns the header of `module`.  A package's ``__init__`` module
+    uses the header of the package.
+    """
+    names = module.split('.')
+    if len(names) > 1 and names[-1] == '__init__':
+        names.pop()
+    return '/'.join(names) + '.h'
+
+def module_header(module_name, root, level, module):
+    """Returns what the module `module_name` has to ``#import`` for
+    `module`, imported with `level` leading dots, or `None` if it's not a
+    module of the project or a framework.
+    """
+    if not level:
+        package = module.partition('.')[0]
+        if package in FRAMEWORKS:
+            return '<%s/%s.h>' % (package, package)
+        if not is_project_module(module_name, root, module):
+            return None
+    return '"%s"' % header_filename(resolve_module(module_name, level, module))
+
+def is_project_module(module_name, root, module):
+    """Tells if the absolute import of `module` by `module_name` is one of
+    the project, i.e. below the same package or in the directory `root`.
+    """
+    package = module.partition('.')[0]
+    if package in sys.stdlib_module_names:
+        return False
+    if '.' in module_name and package == module_name.partition('.')[0]:
+        return True
+    if root is None:
+        return False
+    pathname = os.path.join(root, *module.split('.'))
+    return os.path.isfile(pathname + '.py') or \
+           os.path.isfile(os.path.join(pathname, '__init__.py'))
+
+def resolve_module(module_name, level, module):
+    """Returns the absolute name of `module` imported with `level` leading
+    dots by the module `module_name`.
+    """
+    if not level:
+        return module
+    package = module_name.rsplit('.', level)
+    package = len(package) > level and package[0] or ''
+    return '.'.join(name for name in (package, module) if name)
+
+def declaration(objc_type, name):
+    if objc_type.endswith('*'):
+        return objc_type + name
+    return '%s %s' % (objc_type, name)
+
+def selector_for_call(node):
+    """Returns the Objective-C selector a method call is translated to, e.g.
+    ``setImage:`` for ``x.setImage_(image)``.
+    """
+    method_name = node.func.attr
+    if not node.args:
+        return method_name
+    arg_names = method_name.split('_')
+    return ''.join('%s:' % name for name, arg in zip(arg_names, node.args))
+
+def comment_text(stmt):
+    """Returns the text of a comment that went through the `__comment__`
+    pre-processing, or `None` if `stmt` is an ordinary statement.
+    """
+    if isinstance(stmt, Assign) and len(stmt.targets) == 1 and \
+       isinstance(stmt.targets[0], Name) and \
+       stmt.targets[0].id == '__comment__' and \
+       isinstance(stmt.value, Constant) and isinstance(stmt.value.value, str):
+        return stmt.value.value
+    return None
+
+def comment_pragmas(stmt):
+    """Returns the set of `PRAGMAS` named by a comment statement."""
+    text = comment_text(stmt)
+    if text is None:
+        return set()
+    text = text.strip()
+    if text.startswith('pragma:'):
+        text = text[len('pragma:'):]
+    names = set(name.strip() for name in text.split(','))
+    if not names.issubset(PRAGMAS):
+        return set()
+    return names
+
+def find_loop_pragmas(tree):
+    """Maps every loop in `tree` that directly follows a pragma comment to
+    the set of pragmas named by that comment.
+    """
+    pragmas = {}
+    for node in walk(tree):
+        for field in ('body', 'orelse', 'finalbody'):
+            statements = getattr(node, field, None)
+            if not isinstance(statements, list):
+                continue
+            for previous, stmt in zip(statements, statements[1:]):
+                if isinstance(stmt, (For, While)):
+                    names = comment_pragmas(previous)
+                    if names:
+                        pragmas[stmt] = names
+    return pragmas
+
+def loop_nodes(statements, skip=(FunctionDef, ClassDef, Lambda)):
+    """Yields all nodes of `statements` that are executed as part of the
+    statements themselves, i.e. without descending into nested function,
+    class or lambda definitions, or whatever other node types are in `skip`.
+    """
+    todo = deque(statements)
+    while todo:
+        node = todo.popleft()
+        yield node
+        if isinstance(node, skip):
+            continue
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                todo.extend(item for item in value if hasattr(item, '_fields'))
+            elif hasattr(value, '_fields'):
+                todo.append(value)
+
+def is_allocation(node):
+    """Checks if `node` is a call that creates an object: instantiations
+    (``Foo()``), sends of `ALLOCATING_SELECTORS` and factory methods sent to
+    a class (``NSColor.whiteColor()``).
+    """
+    if not isinstance(node, Call):
+        return False
+    func = node.func
+    if isinstance(func, Name):
+        return func.id[:1].isupper()
+    if isinstance(func, Attribute):
+        if func.attr in ALLOCATING_SELECTORS:
+            return True
+        return isinstance(func.value, Name) and func.value.id[:1].isupper()
+    return False
+
+def is_invariant(expr, assigned_names, assigned_attrs):
+    """Checks if `expr` is a name or attribute chain (``self.image_UI``) that
+    is not rebound by the statements `assigned_names` and `assigned_attrs`
+    were collected from.
+    """
+    while isinstance(expr, Attribute):
+        if expr.attr in assigned_attrs:
+            return False
+        expr = expr.value
+    return isinstance(expr, Name) and expr.id not in assigned_names
+
 
 class SourceGenerator(NodeVisitor):
     """This visitor is able to transform a well formed syntax tree into python
@@ -101,18 +827,49 @@ class SourceGenerator(NodeVisitor):
     `node_to_source` function.
     """
 
-    def __init__(self, indent_with, stream, add_line_information=False):
+    def __init__(self, indent_with, stream, add_line_information=False,
+                 autorelease_threshold=1):
         self.stream = stream
         self._new = True
         self.indent_with = indent_with
         self.add_line_information = add_line_information
         self.indentation = 0
         self.new_lines = 0
-        self.inClassDef = False
-        self.currentClassAttributes = set()
-        self.currentClassAttributeTypes = {}
+        self.currentClass = None
         self.classAttributes = {}
+        self.classAttributeTypes = {}
+        self.classSuperclasses = {}
+        # imported modules and classes as (level, module) pairs
+        self.imported_modules = []
+        self.imported_classes = {}
+        # name -> module bound to it by ``import``
+        self.imported_module_names = {}
         self.inMethodDef = False
+        self.loop_pragmas = {}
+        self.function_pragmas = set()
+        self.cached_imps = {}
+        self.imp_count = 0
+        # string variable -> `NSMutableString` a loop appends to instead
+        self.string_builders = {}
+        self.builder_count = 0
+        # the names of the `SLICE_FUNCTIONS` that are used
+        self.slice_functions = set()
+        self.slice_count = 0
+        self.try_count = 0
+        # the variables declared in each C block that is open
+        self.declared_names = [set()]
+        # the module or function whose body is being written
+        self.scope = None
+        self.in_parallel_loop = False
+        # whether `continue` leaves the block of a `parallel` loop
+        self.continue_returns = False
+        self.autorelease_threshold = autorelease_threshold
+        self.local_types = {}
+        self.membership_sets = []
+        self.membership_set_names = {}
+        # attributes called as methods; the tree itself is never written to,
+        # so one tree can be rendered by several generators at once
+        self.method_attributes = set()
 
     def write(self, x):
         assert(isinstance(x, str))
@@ -130,19 +887,26 @@ class SourceGenerator(NodeVisitor):
             self.write('# line: %s' % node.lineno)
             self.new_lines = 1
 
-    def body(self, statements):
+    def body(self, statements, prologue=None):
         self.new_line = True
         self.indentation += 1
+        self.declared_names.append(set())
+        if prologue is not None:
+            prologue()
         for stmt in statements:
             self.visit(stmt)
         if not statements:
             self.visit(Pass())
+        self.declared_names.pop()
         self.indentation -= 1
         self.newline()
         self.write('}')
 
-    def body_or_else(self, node):
-        self.body(node.body)
+    def body_or_else(self, node, prologue=None):
+        self.body(node.body, prologue)
+        self.orelse(node)
+
+    def orelse(self, node):
         if node.orelse:
             self.newline()
             self.write('else {')
@@ -156,9 +920,12 @@ class SourceGenerator(NodeVisitor):
             else:
                 want_comma.append(True)
 
-        padding = [None] * (len(node.args) - len(node.defaults))
-        for arg, default in zip(node.args, padding + node.defaults):
-            if self.inClassDef and arg.id == 'self':
+        positional = node.posonlyargs + node.args
+        padding = [None] * (len(positional) - len(node.defaults))
+        arguments = list(zip(positional, padding + node.defaults)) + \
+                    list(zip(node.kwonlyargs, node.kw_defaults))
+        for arg, default in arguments:
+            if self.currentClass is not None and arg.arg == 'self':
                 continue
             write_comma()
             self.write('id ')
@@ -168,43 +935,218 @@ class SourceGenerator(NodeVisitor):
                 self.visit(default)
         if node.vararg is not None:
             write_comma()
-            self.write('*' + node.vararg)
+            self.write('*' + node.vararg.arg)
         if node.kwarg is not None:
             write_comma()
-            self.write('**' + node.kwarg)
+            self.write('**' + node.kwarg.arg)
 
     def decorators(self, node):
         for decorator in node.decorator_list:
+            if isinstance(decorator, Name) and decorator.id in PRAGMAS:
+                continue
             self.newline(decorator)
             self.write('@')
             self.visit(decorator)
 
+    def pragmas(self, node):
+        return self.loop_pragmas.get(node, set()) | self.function_pragmas
+
+    def needs_autoreleasepool(self, node):
+        """Checks if every iteration of the loop `node` should get its own
+        autorelease pool.  Allocations in nested loops are left to the pools
+        of those loops.
+        """
+        pragmas = self.pragmas(node)
+        if 'no_autoreleasepool' in pragmas:
+            return False
+        if 'autoreleasepool' in pragmas:
+            return True
+        if self.autorelease_threshold is None:
+            return False
+        skip = (FunctionDef, ClassDef, Lambda, For, While)
+        allocations = 0
+        for child in loop_nodes(node.body, skip):
+            if is_allocation(child):
+                allocations += 1
+        return allocations >= self.autorelease_threshold
+
+    def loop_body(self, node, prologue=None, orelse=True):
+        """Writes the body of the loop `node`, and its ``else`` clause if
+        `orelse` is set.  The function `prologue` is called at the start of
+        the body to write the statements that set up the iteration.
+        """
+        if self.needs_autoreleasepool(node):
+            self.indentation += 1
+            self.newline()
+            self.write('@autoreleasepool {')
+            self.body(node.body, prologue)
+            self.indentation -= 1
+            self.newline()
+            self.write('}')
+        else:
+            self.body(node.body, prologue)
+        if orelse:
+            self.orelse(node)
+
+    def cache_imps(self, node, statements):
+        """Hoists the method lookups for all message sends in `statements`
+        whose receiver is not rebound inside the loop `node`.  The `IMP` is
+        fetched once with ``methodForSelector:`` before the loop and the
+        sends inside the loop call through the function pointer instead.
+        The calls are skipped for a `nil` receiver, whose `IMP` is `NULL`,
+        just like a message to `nil` is.  All methods are taken to take and
+        return objects, see `PRAGMAS`.
+        """
+        if 'imp_cache' not in self.pragmas(node):
+            return
+        nodes = list(loop_nodes(statements))
+        assigned_names = set()
+        assigned_attrs = set()
+        for child in nodes:
+            if isinstance(getattr(child, 'ctx', None), (Store, Del)):
+                if isinstance(child, Name):
+                    assigned_names.add(child.id)
+                elif isinstance(child, Attribute):
+                    assigned_attrs.add(child.attr)
+        if isinstance(node, For):
+            for child in walk(node.target):
+                if isinstance(child, Name):
+                    assigned_names.add(child.id)
+
+        lookups = {}
+        for child in nodes:
+            if not isinstance(child, Call) or child in self.cached_imps or \
+               not isinstance(child.func, Attribute) or self.is_join(child):
+                continue
+            receiver = child.func.value
+            if not is_invariant(receiver, assigned_names, assigned_attrs):
+                continue
+            selector = selector_for_call(child)
+            key = (ast_dump(receiver), selector)
+            if key not in lookups:
+                index = self.imp_count
+                self.imp_count += 1
+                if isinstance(receiver, Name):
+                    receiver_name = receiver.id
+                else:
+                    receiver_name = '_recv%d' % index
+                    self.newline()
+                    self.write('id %s = ' % receiver_name)
+                    self.visit(receiver)
+                arg_types = ''.join(', id' for arg in child.args)
+                self.newline()
+                self.write('SEL _sel%d = @selector(%s)' % (index, selector))
+                self.newline()
+                self.write('id (*_imp%d)(id, SEL%s) = (id (*)(id, SEL%s))[%s '
+                           'methodForSelector:_sel%d]' % (index, arg_types,
+                           arg_types, receiver_name, index))
+                lookups[key] = (receiver_name, '_sel%d' % index,
+                                '_imp%d' % index)
+            self.cached_imps[child] = lookups[key]
+
+    def loop_string_builders(self, node):
+        """Returns the string variables that the loop `node` only appends to
+        and doesn't read otherwise.  These are built in one `NSMutableString`
+        instead of copying the whole string on every append.
+        """
+        candidates = set(name for name, objc_type in self.local_types.items()
+                         if objc_type in STRING_TYPES)
+        candidates.difference_update(self.string_builders)
+        if not candidates:
+            return []
+        statements = node.body + node.orelse
+        if isinstance(node, For):
+            statements = [node.target] + statements
+        elif isinstance(node, While):
+            statements = [node.test] + statements
+        nodes = list(loop_nodes(statements))
+        appended = set()
+        append_names = set()
+        for child in nodes:
+            append = string_append(child)
+            if append is not None and append[0].id in candidates:
+                appended.add(append[0].id)
+                append_names.add(append[0])
+                if isinstance(child, Assign):
+                    # the `s` that ``s = s + x`` starts with
+                    append_names.add(addition_operands(child.value)[0])
+        used = set(child.id for child in nodes
+                   if isinstance(child, Name) and child not in append_names)
+        return sorted(appended - used)
+
+    def start_string_builders(self, node):
+        names = self.loop_string_builders(node)
+        for name in names:
+            builder = '_builder%d' % self.builder_count
+            self.builder_count += 1
+            self.newline()
+            self.write('NSMutableString *%s = [%s mutableCopy]' % (builder,
+                                                                    name))
+            self.string_builders[name] = builder
+        return names
+
+    def finish_string_builders(self, names):
+        for name in names:
+            self.newline()
+            self.write('%s = %s' % (name, self.string_builders.pop(name)))
+
+    def append_string(self, builder, operands):
+        """Writes the appends of the string `operands` to the
+        `NSMutableString` `builder`.
+        """
+        if len(operands) == 1 and isinstance(operands[0], BinOp) and \
+           isinstance(operands[0].op, Add) and self.is_string(operands[0]):
+            operands = addition_operands(operands[0])
+        if len(operands) > 1:
+            self.write_format(builder + ' appendFormat',
+                              *self.concatenation_format(operands))
+            return
+        string_format = self.string_format(operands[0])
+        if string_format is not None:
+            self.write_format(builder + ' appendFormat', *string_format)
+        else:
+            self.write('[%s appendString:' % builder)
+            self.visit(operands[0])
+            self.write(']')
+
 
     # Statements
 
+    def visit_Module(self, node):
+        self.loop_pragmas = find_loop_pragmas(node)
+        self.scope = node
+        self.generic_visit(node)
+
     def visit_Assign(self, node):
-        if self.inClassDef and not self.inMethodDef:
+        if self.currentClass is not None and not self.inMethodDef and \
+           comment_text(node) is None:
             for target in node.targets:
                 target_id = id_string(target)
-                self.currentClassAttributes.add(target_id)
-                if hasattr(node.value, 'func'):
-                    self.currentClassAttributeTypes[target_id] = '%s id' % id_string(node.value.func)
-                elif hasattr(node.value, 'elts'):
-                    # this attribute is a list!
-                    self.currentClassAttributeTypes[target_id] = 'NSArray *'
-                elif hasattr(node.value, 'n'):
-                    # this attribute is a number!
-                    self.currentClassAttributeTypes[target_id] = repr(type(node.value.n)).split("'")[1]
-                elif hasattr(node.value, 's'):
-                    # this attribute is a string!
-                    self.currentClassAttributeTypes[target_id] = 'NSString *'
-                elif hasattr(node.value, 'id') and node.value.id in ('True', 'False'):
-                    self.currentClassAttributeTypes[target_id] = 'BOOL'
+                if self.declaring_class(target_id) != self.currentClass:
+                    # the superclass declares the property already
+                    continue
+                self.classAttributes[self.currentClass].add(target_id)
+                objc_type = self.value_type(node.value)
+                if objc_type is not None:
+                    self.classAttributeTypes[self.currentClass][target_id] = \
+                        objc_type
                 else:
-                    print 'unknown member type:', node.value
-                    print dir(node.value)
+                    print('unknown member type:', node.value)
+                    print(dir(node.value))
         else:
+            objc_type = self.value_type(node.value)
+            for target in node.targets:
+                if isinstance(target, Name):
+                    if objc_type is not None:
+                        self.local_types[target.id] = objc_type
+                    else:
+                        self.local_types.pop(target.id, None)
             self.newline(node)
+            append = string_append(node)
+            if append is not None and append[0].id in self.string_builders:
+                self.append_string(self.string_builders[append[0].id],
+                                   append[1])
+                return
             for idx, target in enumerate(node.targets):
                 if idx:
                     self.write(', ')
@@ -214,21 +1156,44 @@ class SourceGenerator(NodeVisitor):
 
     def visit_AugAssign(self, node):
         self.newline(node)
+        append = string_append(node)
+        if append is not None and append[0].id in self.string_builders:
+            self.append_string(self.string_builders[append[0].id], append[1])
+            return
+        if isinstance(node.op, Add) and self.is_string(node.target):
+            self.visit(node.target)
+            self.write(' = ')
+            operands = [node.value]
+            if isinstance(node.value, BinOp) and self.is_string(node.value):
+                operands = addition_operands(node.value)
+            self.write_concatenation([node.target] + operands)
+            return
         self.visit(node.target)
         self.write(' '+BINOP_SYMBOLS[type(node.op)] + '= ')
         self.visit(node.value)
 
     def visit_ImportFrom(self, node):
         self.newline(node)
-        self.write('// Python: from %s%s import ' % ('.' * node.level, node.module))
+        self.write('// Python: from %s%s import ' % ('.' * node.level,
+                                                     node.module or ''))
         for idx, item in enumerate(node.names):
             if idx:
                 self.write(', ')
             self.visit(item)
+            if node.module is None:
+                # ``from . import module``
+                self.imported_modules.append((node.level, item.name))
+            else:
+                self.imported_classes[item.asname or item.name] = \
+                    (node.level, node.module)
+        if node.module is not None:
+            self.imported_modules.append((node.level, node.module))
 
     def visit_Import(self, node):
-        self.newline(node)
         for item in node.names:
+            self.imported_modules.append((0, item.name))
+            self.imported_module_names[item.asname or item.name] = item.name
+            self.newline(node)
             self.write('// Python: import ')
             self.visit(item)
 
@@ -237,11 +1202,29 @@ class SourceGenerator(NodeVisitor):
         self.generic_visit(node)
 
     def visit_FunctionDef(self, node):
+        outer_in_method_def = self.inMethodDef
         self.inMethodDef = True
+        outer_function_pragmas = self.function_pragmas
+        self.function_pragmas = set(decorator.id for decorator in
+                                    node.decorator_list
+                                    if isinstance(decorator, Name) and
+                                    decorator.id in PRAGMAS)
+        outer_local_types = self.local_types
+        self.local_types = {}
+        outer_declared_names = self.declared_names
+        self.declared_names = []
+        outer_string_builders = self.string_builders
+        self.string_builders = {}
+        outer_scope = self.scope
+        self.scope = node
+        outer_in_parallel_loop = self.in_parallel_loop
+        self.in_parallel_loop = False
+        outer_continue_returns = self.continue_returns
+        self.continue_returns = False
         self.newline(extra=1)
         self.decorators(node)
         self.newline(node)
-        if self.inClassDef:
+        if self.currentClass is not None:
             self.write('- (id)')
 
             node_name = node.name
@@ -263,7 +1246,7 @@ class SourceGenerator(NodeVisitor):
                     prefix_count = i
 
             suffix_count = 0
-            for i in xrange(len(signature_items)-1, -1, -1):
+            for i in range(len(signature_items)-1, -1, -1):
                 s = signature_items[i]
                 if len(s) != 0:
                     suffix_count = i
@@ -284,7 +1267,7 @@ class SourceGenerator(NodeVisitor):
             if suffix_count > 0:
                 signature_items[0] += '_' * suffix_count
 
-            if node.args.args[0].id == "self":
+            if node.args.args and node.args.args[0].arg == "self":
                 args_without_self = node.args.args[1:]
             else:
                 args_without_self = node.args.args
@@ -327,18 +1310,29 @@ class SourceGenerator(NodeVisitor):
                 self.write(' ')
 
             self.write('{')
-
-            node.name = node_name
         else:
             self.write('id %s(' % node.name)
             self.signature(node.args)
             self.write(') {')
         self.body(node.body)
-        self.inMethodDef = False
+        self.inMethodDef = outer_in_method_def
+        self.function_pragmas = outer_function_pragmas
+        self.local_types = outer_local_types
+        self.declared_names = outer_declared_names
+        self.string_builders = outer_string_builders
+        self.scope = outer_scope
+        self.in_parallel_loop = outer_in_parallel_loop
+        self.continue_returns = outer_continue_returns
 
     def visit_ClassDef(self, node):
-        self.inClassDef = True
-        self.currentClassAttributes = set()
+        outer_class = self.currentClass
+        outer_in_method_def = self.inMethodDef
+        self.currentClass = node.name
+        self.inMethodDef = False
+        # Objective-C has one namespace for classes, so the properties of
+        # classes of the same name end up in one interface
+        self.classAttributes.setdefault(node.name, set())
+        self.classAttributeTypes.setdefault(node.name, {})
         have_args = []
         def paren_or_comma():
             if have_args:
@@ -351,17 +1345,28 @@ class SourceGenerator(NodeVisitor):
         self.newline(node)
         self.write('@implementation %s' % node.name)
         className = node.name
+        if node.bases and isinstance(node.bases[0], Name):
+            self.classSuperclasses[className] = node.bases[0].id
+        elif node.bases and isinstance(node.bases[0], Attribute):
+            # ``module.Class``, Objective-C only knows the class name
+            base = node.bases[0]
+            self.classSuperclasses[className] = base.attr
+            module = self.imported_module_names.get(dotted_name(base.value))
+            if module is not None:
+                self.imported_classes.setdefault(base.attr, (0, module))
         for base in node.bases:
             paren_or_comma()
-            self.visit(base)
+            if isinstance(base, Attribute) and dotted_name(base) is not None:
+                self.write(base.attr)
+            else:
+                self.visit(base)
         
         for stmt in node.body:
             self.visit(stmt)
         self.newline()
         self.write('\n@end')
-        self.inClassDef = False
-        self.classAttributes[className] = self.currentClassAttributes
-        del self.currentClassAttributes
+        self.currentClass = outer_class
+        self.inMethodDef = outer_in_method_def
 
     def visit_If(self, node):
         self.newline(node)
@@ -386,50 +1391,368 @@ class SourceGenerator(NodeVisitor):
                 break
 
     def visit_For(self, node):
+        self.cache_imps(node, node.body)
+        builders = self.start_string_builders(node)
+        outer_continue_returns = self.continue_returns
+        self.continue_returns = False
+        if self.runs_in_parallel(node):
+            self.visit_parallel_For(node)
+        elif is_slice(node.iter) and isinstance(node.target, Name):
+            self.visit_sliced_For(node)
+        else:
+            self.newline(node)
+            self.write('for (id ')
+            self.visit(node.target)
+            self.write(' in ')
+            self.visit(node.iter)
+            self.write(') {')
+            self.loop_body(node)
+        self.continue_returns = outer_continue_returns
+        self.finish_string_builders(builders)
+
+    def runs_in_parallel(self, node):
+        """Checks if the loop `node` is marked `parallel` and its iterations
+        can run in parallel.  If they can't, the reason is written as a
+        comment.  Loops inside a parallel loop always run sequentially.
+        """
+        if 'parallel' not in self.pragmas(node) or self.in_parallel_loop:
+            return False
+        conflict = self.parallel_conflict(node)
+        if conflict is not None:
+            self.newline(node)
+            self.write('// parallel: runs sequentially, %s' % conflict)
+            return False
+        return True
+
+    def sequence_writer(self, sequence, index, conversion=None):
+        """Returns a function that writes the sequence `sequence`.  Unless
+        it is a name or attribute chain (and doesn't need the `conversion`
+        message, e.g. ``allKeys``), it is evaluated once into a variable
+        first.
+        """
+        if conversion is None and is_simple(sequence):
+            return lambda: self.visit(sequence)
+        self.write('id _sequence%d = ' % index)
+        if conversion is None:
+            self.visit(sequence)
+        else:
+            self.write('[')
+            self.operand(sequence, ATOM_PRECEDENCE)
+            self.write(' %s]' % conversion)
+        self.newline()
+        return lambda: self.write('_sequence%d' % index)
+
+    def write_slice_indices(self, slice, index, write_sequence, length):
+        """Writes the statements computing the indices of the slice `slice`
+        of the sequence written by `write_sequence`, which has the `length`
+        message ``count`` or ``length``.  Returns the C expressions for the
+        number of elements, the first index and the step, which is `None`
+        for a step of 1.
+        """
+        if not has_step(slice):
+            self.slice_functions.add('_sliceRange')
+            self.write('NSRange _range%d = _sliceRange([' % index)
+            write_sequence()
+            self.write(' %s], ' % length)
+            self.write_slice_bounds(slice)
+            self.write(')')
+            self.newline()
+            return '_range%d.length' % index, '_range%d.location' % index, None
+        self.slice_functions.add('_sliceIndices')
+        self.write('NSInteger _start%d = ' % index)
+        self.write_slice_bound(slice.lower)
+        self.write(', _stop%d = ' % index)
+        self.write_slice_bound(slice.upper)
+        self.write(', _step%d = ' % index)
+        self.visit(slice.step)
+        self.newline()
+        self.write('NSInteger _count%d = _sliceIndices([' % index)
+        write_sequence()
+        self.write(' %s], &_start%d, &_stop%d, _step%d)' % (length, index,
+                                                            index, index))
+        self.newline()
+        return '_count%d' % index, '_start%d' % index, '_step%d' % index
+
+    def declare(self, name):
+        """Records that the variable `name` is declared in the current C
+        block.  Returns `False` if it is visible there already.
+        """
+        for names in self.declared_names:
+            if name in names:
+                return False
+        self.declared_names[-1].add(name)
+        return True
+
+    def element_writer(self, name, is_string, write_sequence, position,
+                       declared=False):
+        """Returns a function that sets the loop variable `name` to the
+        element of the sequence at the C expression `position`, and declares
+        it unless it is `declared` already.
+        """
+        if is_string:
+            self.local_types[name] = 'NSString *'
+        else:
+            self.local_types.pop(name, None)
+
+        def write_element():
+            self.newline()
+            if not declared:
+                self.write(is_string and 'NSString *' or 'id ')
+            if is_string:
+                self.write('%s = [' % name)
+                write_sequence()
+                self.write(' substringWithRange:NSMakeRange(%s, 1)]' %
+                           position)
+            else:
+                self.write('%s = [' % name)
+                write_sequence()
+                self.write(' objectAtIndex:%s]' % position)
+        return write_element
+
+    def visit_sliced_For(self, node):
+        """Writes a loop over a slice as a loop over the indices of the
+        slice, so that the sliced sequence is never copied.  The loop
+        variable is declared before the loop, so it can be read after it.
+        """
+        index = self.slice_count
+        self.slice_count += 1
+        is_string = self.is_string(node.iter.value)
         self.newline(node)
-        self.write('for ')
-        self.visit(node.target)
-        self.write(' in ')
-        self.visit(node.iter)
-        self.write(':')
-        self.body_or_else(node)
+        write_sequence = self.sequence_writer(node.iter.value, index)
+        count, first, step = self.write_slice_indices(
+            node.iter.slice, index, write_sequence,
+            is_string and 'length' or 'count')
+        name = node.target.id
+        if self.declare(name):
+            self.write(declaration(is_string and 'NSString *' or 'id', name))
+            self.newline()
+        if step is None:
+            self.write('for (NSUInteger _i%d = _range%d.location; _i%d < '
+                       'NSMaxRange(_range%d); _i%d++) {' % ((index,) * 5))
+        else:
+            self.write('for (NSInteger _n%d = 0, _i%d = _start%d; _n%d < '
+                       '_count%d; _n%d++, _i%d += _step%d) {' % ((index,) * 8))
+        self.loop_body(node, self.element_writer(name, is_string,
+                                                 write_sequence,
+                                                 '_i%d' % index, True))
+
+    def parallel_conflict(self, node):
+        """Returns why the iterations of the loop `node` can't run in
+        parallel, or `None` if they can.  They can't if the body writes to
+        a variable the rest of the function uses, or reads a variable before
+        assigning it in the same iteration, as either would carry values
+        from one iteration to another.  Attributes and items updated in
+        place (``+=``) are refused as well, but other messages and stores
+        that change shared objects aren't checked; those have to be thread
+        safe.
+        """
+        if not isinstance(node, For):
+            return 'only for loops can run in parallel'
+        if not isinstance(node.target, Name):
+            return 'the loop variable is not a name'
+        if is_range_call(node.iter):
+            step = range_step(node.iter)
+            if step is None:
+                return 'the range step is not a constant'
+            elif step == 0:
+                return 'the range step is zero'
+        for child in loop_nodes(node.body, (FunctionDef, ClassDef, Lambda,
+                                            For, While)):
+            if isinstance(child, Break):
+                return 'the loop body contains break'
+        for child in loop_nodes(node.body):
+            if isinstance(child, (Return, Yield, YieldFrom, Await, Global,
+                                  Nonlocal)):
+                return 'the loop body contains %s' % \
+                       type(child).__name__.lower()
+
+        written = set(stored_names(node.body))
+        outer_names = self.outer_names(node, written | set([node.target.id]))
+        if node.target.id in outer_names:
+            return '%s is used after the loop' % node.target.id
+        for name in sorted(written & outer_names):
+            return 'the loop body writes to the outer variable %s' % name
+        for child in loop_nodes(node.body):
+            if isinstance(child, AugAssign) and \
+               not isinstance(child.target, Name):
+                return 'the loop body updates %s in place' % \
+                       unparse(child.target)
+        name = read_before_assignment(node.body, set([node.target.id]),
+                                      written)
+        if name is not None:
+            return '%s is read before it is assigned' % name
+        return None
+
+    def outer_names(self, node, names):
+        """Returns the `names` whose values the rest of the enclosing
+        function (or module) may see after the loop `node` assigned them.
+        These are the ones read after the loop, or on the next iteration of
+        an enclosing loop, before they are assigned again, the global and
+        nonlocal ones and the ones nested functions and classes use.
+        """
+        path = statement_path(None, self.scope.body, node)
+        if path is None:
+            return set(names)
+        outer = set()
+        for child in loop_nodes(self.scope.body):
+            if isinstance(child, (FunctionDef, ClassDef, Lambda)):
+                outer.update(grandchild.id for grandchild in walk(child)
+                             if isinstance(grandchild, Name))
+            elif isinstance(child, (Global, Nonlocal)):
+                outer.update(child.names)
+        outer &= set(names)
+        statements = statements_after(path)
+        while True:
+            name = read_before_assignment(statements, set(),
+                                          set(names) - outer)
+            if name is None:
+                return outer
+            outer.add(name)
+
+    def block_locals(self, node):
+        """Returns the types of the variables the body of the parallel loop
+        `node` assigns, which are local to the block that runs an iteration.
+        The loop variables of nested loops are declared by those loops.
+        """
+        names = set(child.id for child in loop_nodes(node.body)
+                    if isinstance(child, Name) and
+                    isinstance(child.ctx, Store))
+        for child in loop_nodes(node.body):
+            if isinstance(child, For):
+                names.difference_update(stored_names([child.target]))
+        names.discard(node.target.id)
+        types = {}
+        for child in loop_nodes(node.body):
+            if isinstance(child, Assign):
+                objc_type = self.value_type(child.value) or 'id'
+                for target in child.targets:
+                    if isinstance(target, Name) and \
+                       types.setdefault(target.id, objc_type) != objc_type:
+                        types[target.id] = 'id'
+        return dict((name, types.get(name, 'id')) for name in names)
+
+    def visit_parallel_For(self, node):
+        """Runs the iterations of the loop `node` concurrently with
+        ``dispatch_apply``.  Loops over ``range`` count the loop variable up
+        from the start, and loops over sequences and slices index into the
+        sequence.  ``continue`` returns from the block, and the variables
+        the body assigns are declared in it.
+        """
+        index = self.slice_count
+        self.slice_count += 1
+        name = node.target.id
+        self.newline(node)
+        if is_range_call(node.iter):
+            args = node.iter.args
+            self.write('NSInteger _start%d = ' % index)
+            if len(args) > 1:
+                self.visit(args[0])
+            else:
+                self.write('0')
+            self.write(', _stop%d = ' % index)
+            self.visit(args[len(args) > 1 and 1 or 0])
+            self.newline()
+            step = range_step(node.iter)
+            if step > 0:
+                distance = '_stop%d - _start%d' % (index, index)
+            else:
+                distance = '_start%d - _stop%d' % (index, index)
+            if abs(step) == 1:
+                count = 'MAX(%s, 0)' % distance
+            else:
+                count = 'MAX((%s + %d) / %d, 0)' % (distance, abs(step) - 1,
+                                                     abs(step))
+            position = '_start%d + (NSInteger)_i%d' % (index, index)
+            if step != 1:
+                position += ' * %d' % step
+            self.local_types[name] = 'NSInteger'
+
+            def write_element():
+                self.newline()
+                self.write('NSInteger %s = %s' % (name, position))
+        elif is_slice(node.iter):
+            is_string = self.is_string(node.iter.value)
+            write_sequence = self.sequence_writer(node.iter.value, index)
+            count, first, step = self.write_slice_indices(
+                node.iter.slice, index, write_sequence,
+                is_string and 'length' or 'count')
+            position = '%s + (NSInteger)_i%d' % (first, index)
+            if step is not None:
+                position += ' * ' + step
+            write_element = self.element_writer(name, is_string,
+                                                write_sequence, position)
+        else:
+            is_string = self.is_string(node.iter)
+            iter_type = self.expression_type(node.iter) or ''
+            conversion = None
+            if 'Dictionary' in iter_type:
+                conversion = 'allKeys'
+            elif 'Set' in iter_type:
+                conversion = 'allObjects'
+            write_sequence = self.sequence_writer(node.iter, index,
+                                                  conversion)
+            count = None
+            write_element = self.element_writer(name, is_string,
+                                                write_sequence, '_i%d' % index)
+        self.write('dispatch_apply(')
+        if count is None:
+            self.write('[')
+            write_sequence()
+            self.write(is_string and ' length]' or ' count]')
+        else:
+            self.write(count)
+        self.write(', %s, ^(size_t _i%d) {' % (PARALLEL_QUEUE, index))
+        block_locals = self.block_locals(node)
+
+        def prologue():
+            write_element()
+            for local, objc_type in sorted(block_locals.items()):
+                self.declare(local)
+                self.newline()
+                self.write(declaration(objc_type, local))
+        outer_in_parallel_loop = self.in_parallel_loop
+        self.in_parallel_loop = True
+        self.continue_returns = True
+        self.loop_body(node, prologue, orelse=False)
+        self.in_parallel_loop = outer_in_parallel_loop
+        self.write(')')
+        # nothing can break out of the block
+        for stmt in node.orelse:
+            self.visit(stmt)
 
     def visit_While(self, node):
+        self.cache_imps(node, [node.test] + node.body)
+        builders = self.start_string_builders(node)
+        if 'parallel' in self.pragmas(node) and not self.in_parallel_loop:
+            self.newline(node)
+            self.write('// parallel: runs sequentially, %s' %
+                       self.parallel_conflict(node))
+        outer_continue_returns = self.continue_returns
+        self.continue_returns = False
         self.newline(node)
-        self.write('while ')
+        self.write('while (')
         self.visit(node.test)
-        self.write(':')
-        self.body_or_else(node)
+        self.write(') {')
+        self.loop_body(node)
+        self.continue_returns = outer_continue_returns
+        self.finish_string_builders(builders)
 
     def visit_With(self, node):
         self.newline(node)
         self.write('with ')
-        self.visit(node.context_expr)
-        if node.optional_vars is not None:
-            self.write(' as ')
-            self.visit(node.optional_vars)
+        for idx, item in enumerate(node.items):
+            if idx:
+                self.write(', ')
+            self.visit(item.context_expr)
+            if item.optional_vars is not None:
+                self.write(' as ')
+                self.visit(item.optional_vars)
         self.write(':')
         self.body(node.body)
 
     def visit_Pass(self, node):
         self.newline(node)
 
-    def visit_Print(self, node):
-        self.newline(node)
-        self.write('print ')
-        want_comma = False
-        if node.dest is not None:
-            self.write(' >> ')
-            self.visit(node.dest)
-            want_comma = True
-        for value in node.values:
-            if want_comma:
-                self.write(', ')
-            self.visit(value)
-            want_comma = True
-        if not node.nl:
-            self.write(',')
-
     def visit_Delete(self, node):
         self.newline(node)
         self.write('del ')
@@ -438,27 +1761,49 @@ class SourceGenerator(NodeVisitor):
                 self.write(', ')
             self.visit(target)
 
-    def visit_ExceptHandler(self, node):
-        'Not sure why these are different classes, but in py2.7 this is needed'
-        return self.visit_excepthandler(node)
-
-    def visit_TryExcept(self, node):
+    def visit_Try(self, node):
+        """There is no ``@try ... else``.  The body sets a flag when it
+        completes, and the else clause runs after the handlers if the flag
+        is set, so the handlers don't catch its exceptions.  With a finally
+        clause as well, an outer ``@try`` makes sure it runs after the else
+        clause.
+        """
         self.newline(node)
+        flag = None
+        if node.orelse:
+            flag = '_noException%d' % self.try_count
+            self.try_count += 1
+            self.write('BOOL %s = NO' % flag)
+            self.newline()
+        nested = node.orelse and node.finalbody
+        if nested:
+            self.write('@try {')
+            self.indentation += 1
+            self.newline()
         self.write('@try {')
-        self.body(node.body)
+        self.indentation += 1
+        for stmt in node.body:
+            self.visit(stmt)
+        if flag is not None:
+            self.newline()
+            self.write('%s = YES' % flag)
+        self.indentation -= 1
         self.newline()
+        self.write('}')
         for handler in node.handlers:
             self.visit(handler)
-
-    def visit_TryFinally(self, node):
-        self.newline(node)
-        self.write('@try {')
-        self.body(node.body)
-        self.write('}')
-        self.newline(node)
-        self.write('@finally {')
-        self.body(node.finalbody)
-        self.write('}')
+        if flag is not None:
+            self.newline()
+            self.write('if (%s) {' % flag)
+            self.body(node.orelse)
+        if nested:
+            self.indentation -= 1
+            self.newline()
+            self.write('}')
+        if node.finalbody:
+            self.newline()
+            self.write('@finally {')
+            self.body(node.finalbody)
 
     def visit_Global(self, node):
         self.newline(node)
@@ -481,45 +1826,124 @@ class SourceGenerator(NodeVisitor):
 
     def visit_Continue(self, node):
         self.newline(node)
-        self.write('continue')
+        self.write(self.continue_returns and 'return' or 'continue')
 
     def visit_Raise(self, node):
-        # XXX: Python 2.6 / 3.0 compatibility
         self.newline(node)
         self.write('raise')
-        if hasattr(node, 'exc') and node.exc is not None:
+        if node.exc is not None:
             self.write(' ')
             self.visit(node.exc)
             if node.cause is not None:
                 self.write(' from ')
                 self.visit(node.cause)
-        elif hasattr(node, 'type') and node.type is not None:
-            self.visit(node.type)
-            if node.inst is not None:
-                self.write(', ')
-                self.visit(node.inst)
-            if node.tback is not None:
-                self.write(', ')
-                self.visit(node.tback)
 
     # Expressions
 
+    def declaring_class(self, attr):
+        """Returns the class that declares the attribute `attr` of the
+        current class, i.e. its nearest superclass in this module that does,
+        or the current class itself.
+        """
+        seen = set([self.currentClass])
+        class_name = self.classSuperclasses.get(self.currentClass)
+        while class_name in self.classAttributes and class_name not in seen:
+            if attr in self.classAttributes[class_name]:
+                return class_name
+            seen.add(class_name)
+            class_name = self.classSuperclasses.get(class_name)
+        return self.currentClass
+
+    def ivar_access(self, node):
+        """Checks if the attribute `node` of `self` is accessed through its
+        backing ivar.  Inside the class' own methods that is the case for all
+        reads and for all writes that don't need the setter to copy.  The
+        ivars of superclasses are private to them, so inherited attributes
+        always go through the accessors.
+        """
+        if not self.inMethodDef:
+            return False
+        if isinstance(getattr(node, 'ctx', None), Store):
+            objc_type = self.classAttributeTypes[self.currentClass].get(
+                node.attr, 'id')
+            return objc_type not in COPY_TYPES
+        return True
+
     def visit_Attribute(self, node):
+        if not isinstance(node.value, Name):
+            self.visit_chain(node)
+            return
+        is_method = node in self.method_attributes
+        if self.currentClass is not None and node.value.id == 'self' and \
+           self.declaring_class(node.attr) == self.currentClass:
+            self.classAttributes[self.currentClass].add(node.attr)
+            if not is_method and self.ivar_access(node):
+                self.write('_' + node.attr)
+                return
         self.visit(node.value)
-        if hasattr(node.value, 'id') and node.value.id == 'self':
-            self.currentClassAttributes.add(node.attr)
         #print hasattr(node.value, 'func')
         #if hasattr(node.value, 'func'):# and node.func.value.is_method:
-        if hasattr(node, 'is_method') and node.is_method:
+        if is_method:
             self.write(' ')
         else:
             self.write('.')
         self.write(node.attr)
 
-    def visit_Call_class(self, node):
+    def visit_Call_cached(self, node):
+        receiver_name, selector_name, imp_name = self.cached_imps[node]
+        self.write('(%s ? %s(%s, %s' % (receiver_name, imp_name, receiver_name,
+                                        selector_name))
+        for arg in node.args:
+            self.write(', ')
+            self.visit(arg)
+        self.write(') : nil)')
+
+    def chain(self, node):
+        """Splits the chain of attribute accesses, calls and subscripts `node`
+        into the expression it starts with and its links, outermost first.  Long chains
+        like ``a.b().c().d()`` are rendered from this in a loop instead of
+        recursing once per link.
+        """
+        links = []
+        while True:
+            if isinstance(node, Call) and node not in self.cached_imps and \
+               not self.is_join(node):
+                links.append(node)
+                if isinstance(node.func, Attribute):
+                    self.method_attributes.add(node.func)
+                    node = node.func.value
+                else:
+                    node = node.func
+            elif (isinstance(node, Subscript) and not is_slice(node)) or \
+                 (isinstance(node, Attribute) and
+                  not isinstance(node.value, Name)):
+                links.append(node)
+                node = node.value
+            else:
+                return node, links
+
+    def visit_chain(self, node):
+        start, links = self.chain(node)
+        # every method call opens a message send around its receiver
+        sends = [link for link in links
+                 if isinstance(link, Call) and
+                 isinstance(link.func, Attribute)]
+        self.write('[' * len(sends))
+        self.operand(start, ATOM_PRECEDENCE)
+        for link in reversed(links):
+            if isinstance(link, Attribute):
+                self.write('.' + link.attr)
+            elif isinstance(link, Subscript):
+                self.write('[')
+                self.visit(link.slice)
+                self.write(']')
+            elif isinstance(link.func, Attribute):
+                self.method_arguments(link)
+            else:
+                self.call_arguments(link)
+
+    def method_arguments(self, node):
         method_name = node.func.attr
-        self.write('[')
-        self.visit(node.func.value)
         arg_names = method_name.split('_')
         if len(node.args) != 0:
             for name, arg in zip(arg_names, node.args):
@@ -530,7 +1954,28 @@ class SourceGenerator(NodeVisitor):
         self.write(']')
 
     def visit_Call(self, node):
-        node.func.is_method = hasattr(node.func, 'value')
+        if node in self.cached_imps:
+            self.visit_Call_cached(node)
+        elif self.is_join(node):
+            self.visit_join(node)
+        else:
+            self.visit_chain(node)
+
+    def is_join(self, node):
+        """Checks if `node` is a call of ``separator.join(iterable)``."""
+        return isinstance(node, Call) and \
+               isinstance(node.func, Attribute) and \
+               node.func.attr == 'join' and len(node.args) == 1 and \
+               not node.keywords and self.is_string(node.func.value)
+
+    def visit_join(self, node):
+        self.write('[')
+        self.operand(node.args[0], ATOM_PRECEDENCE)
+        self.write(' componentsJoinedByString:')
+        self.visit(node.func.value)
+        self.write(']')
+
+    def call_arguments(self, node):
         want_comma = []
         def write_comma():
             if want_comma:
@@ -538,40 +1983,35 @@ class SourceGenerator(NodeVisitor):
             else:
                 want_comma.append(True)
 
-        if node.func.is_method:
-            self.visit_Call_class(node)
-            return
-        else:    
-            self.visit(node.func)
         self.write('(')
         for arg in node.args:
             write_comma()
             self.visit(arg)
         for keyword in node.keywords:
             write_comma()
-            self.write(keyword.arg + '=')
+            if keyword.arg is None:
+                self.write('**')
+            else:
+                self.write(keyword.arg + '=')
             self.visit(keyword.value)
-        if node.starargs is not None:
-            write_comma()
-            self.write('*')
-            self.visit(node.starargs)
-        if node.kwargs is not None:
-            write_comma()
-            self.write('**')
-            self.visit(node.kwargs)
         self.write(')')
 
     def visit_Name(self, node):
         self.write(node.id)
 
-    def visit_Str(self, node):
-        self.write('@"%s"' % node.s.replace('\n', '\\n'))
-
-    def visit_Bytes(self, node):
-        self.write(repr(node.s))
+    def visit_Constant(self, node):
+        if isinstance(node.value, str):
+            self.write(string_literal(node.value))
+        elif node.value is Ellipsis:
+            self.write('Ellipsis')
+        elif node.value is None or isinstance(node.value, bool):
+            self.write(str(node.value))
+        else:
+            self.write(repr(node.value))
 
-    def visit_Num(self, node):
-        self.write(repr(node.n))
+    def visit_JoinedStr(self, node):
+        self.write_format('NSString stringWithFormat',
+                          *self.fstring_format(node))
 
     def visit_Tuple(self, node):
         self.write('(')
@@ -601,46 +2041,385 @@ class SourceGenerator(NodeVisitor):
         for idx, (key, value) in enumerate(zip(node.keys, node.values)):
             if idx:
                 self.write(', ')
+            if key is None:
+                self.write('**')
+                self.visit(value)
+                continue
             self.visit(key)
             self.write(': ')
             self.visit(value)
         self.write('}')
 
+    def operand_precedence(self, node):
+        if isinstance(node, Compare) and len(node.ops) == 1 and \
+           isinstance(node.ops[0], (In, NotIn)):
+            # lowered to a lookup in parentheses by visit_Membership
+            return ATOM_PRECEDENCE
+        if isinstance(node, BinOp) and self.lowers_to_string(node):
+            return ATOM_PRECEDENCE
+        return precedence(node)
+
+    def operand(self, node, required):
+        """Visits `node`, in parentheses if it binds more loosely than the
+        precedence `required` by its position.
+        """
+        if self.operand_precedence(node) < required:
+            self.write('(')
+            self.visit(node)
+            self.write(')')
+        else:
+            self.visit(node)
+
     def visit_BinOp(self, node):
-        self.visit(node.left)
-        self.write(' %s ' % BINOP_SYMBOLS[type(node.op)])
-        self.visit(node.right)
+        if isinstance(node.op, Add) and self.is_string(node):
+            self.write_concatenation(addition_operands(node))
+            return
+        string_format = self.string_format(node)
+        if string_format is not None:
+            self.write_format('NSString stringWithFormat', *string_format)
+            return
+        # ``a + b + c`` nests on the left, walk down that side in a loop
+        operations = [node]
+        while isinstance(node.left, BinOp) and \
+              precedence(node.left) >= PRECEDENCE[type(node.op)] and \
+              (isinstance(node.op, Add) and isinstance(node.left.op, Add) or
+               not self.lowers_to_string(node.left)):
+            node = node.left
+            operations.append(node)
+        self.operand(node.left, PRECEDENCE[type(node.op)])
+        for operation in reversed(operations):
+            self.write(' %s ' % BINOP_SYMBOLS[type(operation.op)])
+            self.operand(operation.right, PRECEDENCE[type(operation.op)] + 1)
 
     def visit_BoolOp(self, node):
-        self.write('(')
+        required = PRECEDENCE[type(node.op)] + 1
         for idx, value in enumerate(node.values):
             if idx:
                 self.write(' %s ' % BOOLOP_SYMBOLS[type(node.op)])
-            self.visit(value)
+            self.operand(value, required)
+
+    def lowers_to_string(self, node):
+        """Checks if the `BinOp` `node` is written as an `NSString` message."""
+        if isinstance(node.op, Add):
+            return self.is_string(node)
+        return self.string_format(node) is not None
+
+    def write_concatenation(self, operands):
+        """Writes the concatenation of the strings `operands` as one message,
+        so that no intermediate strings are created.
+        """
+        if all(isinstance(operand, Constant) and isinstance(operand.value, str)
+               for operand in operands):
+            self.write(string_literal(''.join(operand.value
+                                              for operand in operands)))
+        elif len(operands) == 2:
+            self.write('[')
+            self.operand(operands[0], ATOM_PRECEDENCE)
+            self.write(' stringByAppendingString:')
+            self.visit(operands[1])
+            self.write(']')
+        else:
+            self.write_format('NSString stringWithFormat',
+                              *self.concatenation_format(operands))
+
+    def write_format(self, message, format_string, arguments):
+        """Writes the message send `message` (e.g. ``NSString
+        stringWithFormat``) with the format string `format_string` and
+        `arguments` as returned by `string_format`.
+        """
+        self.write('[%s:%s' % (message, string_literal(format_string)))
+        for before, argument, after in arguments:
+            self.write(', ' + before)
+            if before:
+                self.operand(argument, ATOM_PRECEDENCE)
+            else:
+                self.visit(argument)
+            self.write(after)
+        self.write(']')
+
+    def string_format(self, node):
+        """Returns the format string and arguments of the `stringWithFormat:`
+        that the f-string or `%` formatting `node` is lowered to, or `None`.
+        The arguments are triples of the text to write before the argument,
+        the argument and the text to write after it.
+        """
+        if isinstance(node, JoinedStr):
+            return self.fstring_format(node)
+        elif isinstance(node, BinOp) and isinstance(node.op, Mod) and \
+             isinstance(node.left, Constant) and \
+             isinstance(node.left.value, str):
+            return self.percent_format(node)
+        return None
+
+    def concatenation_format(self, operands):
+        pieces = []
+        arguments = []
+        for operand in operands:
+            if isinstance(operand, Constant) and isinstance(operand.value, str):
+                pieces.append(operand.value.replace('%', '%%'))
+            else:
+                pieces.append('%@')
+                arguments.append(('', operand, ''))
+        return ''.join(pieces), arguments
+
+    def percent_format(self, node):
+        """Translates ``'format' % arguments``.  Mapping keys, ``*`` widths
+        and conversions without a C equivalent are left to the `%` operator.
+        """
+        if isinstance(node.right, Tuple):
+            values = node.right.elts
+        elif isinstance(node.right, Dict):
+            return None
+        else:
+            values = [node.right]
+        pieces = []
+        arguments = []
+        position = 0
+        for match in FORMAT_SPECIFIER.finditer(node.left.value):
+            pieces.append(node.left.value[position:match.start()])
+            position = match.end()
+            if match.group('conversion') == '%':
+                pieces.append('%%')
+                continue
+            if len(arguments) == len(values):
+                return None
+            value = values[len(arguments)]
+            specifier = format_specifier(*match.group('flags', 'width',
+                                                      'precision',
+                                                      'conversion'),
+                                         objc_type=self.value_type(value))
+            if specifier is None:
+                return None
+            pieces.append(specifier[0])
+            arguments.append((specifier[1], value, specifier[2]))
+        if len(arguments) != len(values):
+            return None
+        pieces.append(node.left.value[position:])
+        return ''.join(pieces), arguments
+
+    def fstring_format(self, node):
+        """Translates an f-string.  Replacement fields whose format spec
+        printf can't express are formatted with `%@`.
+        """
+        pieces = []
+        arguments = []
+        for value in node.values:
+            if isinstance(value, Constant):
+                pieces.append(value.value.replace('%', '%%'))
+                continue
+            flags, width, precision, conversion = '', '', None, 's'
+            spec = value.format_spec
+            if spec is not None and len(spec.values) == 1 and \
+               isinstance(spec.values[0], Constant):
+                match = FORMAT_SPEC.match(spec.values[0].value)
+                if match is not None:
+                    flags, width, precision, conversion = match.group(
+                        'flags', 'width', 'precision', 'conversion')
+                    conversion = conversion or 's'
+            specifier = format_specifier(flags, width, precision, conversion,
+                                         self.value_type(value.value))
+            if specifier is None:
+                specifier = ('%@', '', '')
+            pieces.append(specifier[0])
+            arguments.append((specifier[1], value.value, specifier[2]))
+        return ''.join(pieces), arguments
+
+    def is_string(self, node):
+        """Checks if `node` is an expression of one of the `STRING_TYPES`."""
+        if isinstance(node, Constant):
+            return isinstance(node.value, str)
+        elif isinstance(node, JoinedStr):
+            return True
+        elif isinstance(node, BinOp):
+            if isinstance(node.op, Add):
+                return any(self.is_string(operand)
+                           for operand in addition_operands(node))
+            return isinstance(node.op, Mod) and self.is_string(node.left)
+        elif isinstance(node, Call):
+            return self.is_join(node)
+        return self.expression_type(node) in STRING_TYPES
+
+    def value_type(self, node):
+        """Returns the inferred Objective-C type of the expression `node`, or
+        `None` if there is no good guess.
+        """
+        objc_type = self.expression_type(node) or infer_type(node)
+        if objc_type in (None, 'id') and self.is_string(node):
+            return 'NSString *'
+        if objc_type is None and isinstance(node, BinOp) and \
+           isinstance(node.op, (Add, Sub, Mult)) and \
+           self.value_type(node.left) in INTEGER_TYPES and \
+           self.value_type(node.right) in INTEGER_TYPES:
+            return 'NSInteger'
+        return objc_type
+
+    def expression_type(self, node):
+        """Returns the inferred Objective-C type of `node`, if it is a local
+        variable or an attribute of `self` with a known type.
+        """
+        if isinstance(node, Name):
+            return self.local_types.get(node.id)
+        elif isinstance(node, Attribute) and \
+             self.currentClass is not None and \
+             isinstance(node.value, Name) and node.value.id == 'self':
+            return self.classAttributeTypes[
+                self.declaring_class(node.attr)].get(node.attr)
+        return None
+
+    def membership_set(self, node):
+        """Returns the name of the function returning a static `NSSet` of
+        the elements (or keys) of the constant container `node`, or `None` if
+        `node` is not constant.
+        """
+        if isinstance(node, Dict):
+            elements = node.keys
+        elif isinstance(node, (List, Tuple, Set)):
+            elements = node.elts
+        else:
+            return None
+        literals = tuple(constant_literal(element) for element in elements)
+        if not literals or None in literals:
+            return None
+        key = frozenset(literals)
+        if key not in self.membership_set_names:
+            name = '_membershipSet%d' % len(self.membership_sets)
+            self.membership_sets.append((name, literals))
+            self.membership_set_names[key] = name
+        return self.membership_set_names[key]
+
+    def visit_Membership(self, node):
+        """Lowers ``x in container`` to a lookup in a static `NSSet` if the
+        container is constant, and otherwise to ``objectForKey:`` for
+        dictionaries, ``rangeOfString:`` for strings and ``containsObject:``
+        for everything else.  Other literal containers become an array
+        literal, and empty ones contain nothing.
+        """
+        negate = isinstance(node.ops[0], NotIn)
+        element, container = node.left, node.comparators[0]
+        elements = literal_elements(container)
+        if elements is not None and not elements:
+            self.write(negate and 'YES' or 'NO')
+            return
+        set_name = self.membership_set(container)
+        container_type = self.expression_type(container) or ''
+        self.write('(')
+        if set_name is not None:
+            self.write('%s[%s() containsObject:' % (negate and '!' or '',
+                                                    set_name))
+            self.visit(element)
+            self.write(']')
+        elif 'Dictionary' in container_type:
+            self.write('[')
+            self.visit(container)
+            self.write(' objectForKey:')
+            self.visit(element)
+            self.write(negate and '] == nil' or '] != nil')
+        elif 'String' in container_type:
+            self.write('[')
+            self.visit(container)
+            self.write(' rangeOfString:')
+            self.visit(element)
+            self.write(negate and '].location == NSNotFound' or
+                       '].location != NSNotFound')
+        elif elements is not None:
+            self.write('%s[@[' % (negate and '!' or ''))
+            for idx, item in enumerate(elements):
+                if idx:
+                    self.write(', ')
+                self.write_object(item)
+            self.write('] containsObject:')
+            self.visit(element)
+            self.write(']')
+        else:
+            self.write('%s[' % (negate and '!' or ''))
+            self.visit(container)
+            self.write(' containsObject:')
+            self.visit(element)
+            self.write(']')
         self.write(')')
 
+    def write_object(self, node):
+        """Writes the expression `node` as an object, boxing scalars."""
+        literal = constant_literal(node)
+        if literal is not None:
+            self.write(literal)
+        elif self.value_type(node) in INTEGER_TYPES + FLOAT_TYPES:
+            self.write('@(')
+            self.visit(node)
+            self.write(')')
+        else:
+            self.visit(node)
+
     def visit_Compare(self, node):
-        self.write('(')
-        self.visit(node.left)
+        if len(node.ops) == 1 and isinstance(node.ops[0], (In, NotIn)):
+            self.visit_Membership(node)
+            return
+        required = precedence(node) + 1
+        self.operand(node.left, required)
         for op, right in zip(node.ops, node.comparators):
             self.write(' %s ' % CMPOP_SYMBOLS[type(op)])
-            self.visit(right)
-        self.write(')')
+            self.operand(right, required)
 
     def visit_UnaryOp(self, node):
-        self.write('(')
         op = UNARYOP_SYMBOLS[type(node.op)]
         self.write(op)
-        if op == 'not':
-            self.write(' ')
-        self.visit(node.operand)
-        self.write(')')
+        required = PRECEDENCE[type(node.op)]
+        if op in ('-', '+') and precedence(node.operand) == required:
+            # ``- -x`` must not turn into the ``--`` operator
+            required += 1
+        self.operand(node.operand, required)
 
     def visit_Subscript(self, node):
-        self.visit(node.value)
+        if is_slice(node):
+            self.write_slice(node)
+        else:
+            self.visit_chain(node)
+
+    def write_slice(self, node):
+        """Lowers ``a[i:j]`` to ``subarrayWithRange:`` for arrays and to
+        ``substringWithRange:`` for strings.  Slices with a step and slices
+        of expressions that can't be evaluated twice use `_slice`, which
+        decides between the two at runtime.
+        """
+        sequence = node.value
+        slice = node.slice
+        if has_step(slice) or not is_simple(sequence):
+            self.slice_functions.update(('_sliceIndices', '_slice'))
+            self.write('_slice(')
+            self.visit(sequence)
+            self.write(', ')
+            self.write_slice_bounds(slice)
+            self.write(', ')
+            if has_step(slice):
+                self.visit(slice.step)
+            else:
+                self.write('1')
+            self.write(')')
+            return
+        self.slice_functions.add('_sliceRange')
+        if self.is_string(sequence):
+            message, length = 'substringWithRange', 'length'
+        else:
+            message, length = 'subarrayWithRange', 'count'
         self.write('[')
-        self.visit(node.slice)
-        self.write(']')
+        self.operand(sequence, ATOM_PRECEDENCE)
+        self.write(' %s:_sliceRange([' % message)
+        self.visit(sequence)
+        self.write(' %s], ' % length)
+        self.write_slice_bounds(slice)
+        self.write(')]')
+
+    def write_slice_bound(self, bound):
+        if bound is None or \
+           (isinstance(bound, Constant) and bound.value is None):
+            self.write('NSNotFound')
+        else:
+            self.visit(bound)
+
+    def write_slice_bounds(self, node):
+        self.write_slice_bound(node.lower)
+        self.write(', ')
+        self.write_slice_bound(node.upper)
 
     def visit_Slice(self, node):
         if node.lower is not None:
@@ -650,18 +2429,15 @@ class SourceGenerator(NodeVisitor):
             self.visit(node.upper)
         if node.step is not None:
             self.write(':')
-            if not (isinstance(node.step, Name) and node.step.id == 'None'):
+            if not (isinstance(node.step, Constant) and
+                    node.step.value is None):
                 self.visit(node.step)
 
-    def visit_ExtSlice(self, node):
-        for idx, item in node.dims:
-            if idx:
-                self.write(', ')
-            self.visit(item)
-
     def visit_Yield(self, node):
-        self.write('yield ')
-        self.visit(node.value)
+        self.write('yield')
+        if node.value is not None:
+            self.write(' ')
+            self.visit(node.value)
 
     def visit_Lambda(self, node):
         self.write('lambda ')
@@ -669,15 +2445,12 @@ class SourceGenerator(NodeVisitor):
         self.write(': ')
         self.visit(node.body)
 
-    def visit_Ellipsis(self, node):
-        self.write('Ellipsis')
-
     def generator_visit(left, right):
         def visit(self, node):
             self.write(left)
             self.visit(node.elt)
-            for comprehension in node.generators:
-                self.visit(comprehension)
+            for generator in node.generators:
+                self.visit(generator)
             self.write(right)
         return visit
 
@@ -691,30 +2464,26 @@ class SourceGenerator(NodeVisitor):
         self.visit(node.key)
         self.write(': ')
         self.visit(node.value)
-        for comprehension in node.generators:
-            self.visit(comprehension)
+        for generator in node.generators:
+            self.visit(generator)
         self.write('}')
 
     def visit_IfExp(self, node):
-        self.write('(')
-        self.visit(node.test)
+        self.operand(node.test, PRECEDENCE[Or])
         self.write(' ? ')
         self.visit(node.body)
         self.write(' : ')
-        self.visit(node.orelse)
-        self.write(')')
+        self.operand(node.orelse, PRECEDENCE[IfExp])
 
     def visit_Starred(self, node):
         self.write('*')
         self.visit(node.value)
 
-    def visit_Repr(self, node):
-        self.write('`')
-        self.visit(node.value)
-        self.write('`')
-
     # Helper Nodes
 
+    def visit_arg(self, node):
+        self.write(node.arg)
+
     def visit_alias(self, node):
         self.write(node.name)
         if node.asname is not None:
@@ -730,40 +2499,31 @@ class SourceGenerator(NodeVisitor):
                 self.write(' if ')
                 self.visit(if_)
 
-    def visit_excepthandler(self, node):
+    def visit_ExceptHandler(self, node):
         self.newline(node)
         self.write('@catch (')
         if node.type is not None:
             self.visit(node.type)
             self.write('* ')
             if node.name is not None:
-                self.visit(node.name)
+                self.write(node.name)
         else:
             self.write('id')
         self.write(') {')
         self.body(node.body)
 
 if __name__ == '__main__':
-    import ast
-    import os
-    import sys
+    import frontend
     
     if len(sys.argv) != 2:
-        print "Syntax: codegen_objc <input.py>"
+        print("Syntax: codegen_objc <input.py>")
         sys.exit(1)
 
     input_filename = sys.argv[1]
     pathname = os.getcwd() + "/" + input_filename
 
-    # Pre-processing comments
-    lines = []
     with open(pathname, 'r') as f:
-        for line in f.readlines():
-            if line.strip().startswith('#'):
-                lines.append(line.replace('"', '\\"').replace('#', '__comment__ = "', 1)[:-1]+'"')
-            else:
-                lines.append(line)
-    code = "\n".join(lines)
+        source = f.read()
 
     code2 = """
 # comment
@@ -803,6 +2563,10 @@ class FooCell(NSCell):
         foo().baz_(c)
 """
 
-    node = ast.parse(code)
-
-    print to_source(node)
\ No newline at end of file
+    cache_directory = os.environ.get('CODEGEN_CACHE_DIR')
+    if cache_directory:
+        import codegen_objc
+        from codegen_cache import OutputCache
+        print(OutputCache(cache_directory).translate(source, codegen_objc))
+    else:
+        print(to_source(frontend.parse(source, input_filename)))
\ No newline at end of file
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    frontend
+    ~~~~~~~~
+
+    Parsing shared by the code generators.
+
+    `parse` does the comment pre-processing both generators rely on and
+    parses the result, and `ASTStore` keeps the trees of recently parsed
+    sources, so one source is parsed once no matter how many outputs are
+    generated from it.
+
+        python frontend.py [--python OUT] [--objc OUT] [--optimize] <input.py>
+
+    translates `input.py` with both generators from a single parse.
+
+    :license: BSD, see LICENSE for more details.
+"""
+import ast
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def preprocess_comments(source):
+    """Turns the comments in `source` into `__comment__` assignments, so they
+    survive parsing and are turned back into comments by `to_source`.
+    """
+    lines = []
+    for line in source.splitlines(True):
+        if line.strip().startswith('#'):
+            lines.append(line.rstrip('\n').replace('"', '\\"')
+                         .replace('#', '__comment__ = "', 1) + '"\n')
+        else:
+            lines.append(line)
+    return ''.join(lines)
+
+
+def parse(source, filename='<unknown>'):
+    """Parses the Python code `source` for the code generators."""
+    return ast.parse(preprocess_comments(source), filename)
+
+
+class ASTStore(object):
+    """Keeps the trees of the `max_entries` most recently parsed sources,
+    keyed by the hash of the source.  It can be shared between threads.
+
+    The trees are kept as they are rather than serialized: reading a
+    pickled tree back takes longer than parsing the source again.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.trees = OrderedDict()
+        self.lock = threading.Lock()
+
+    def parse(self, source, filename='<unknown>'):
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self.lock:
+            tree = self.trees.pop(key, None)
+            if tree is not None:
+                self.trees[key] = tree
+                return tree
+        tree = parse(source, filename)
+        with self.lock:
+            self.trees[key] = tree
+            while len(self.trees) > self.max_entries:
+                self.trees.popitem(last=False)
+        return tree
+
+
+def render(tree, generator, **options):
+    """Renders `tree` with the generator module `generator`.  Neither
+    generator changes the tree, so it can be rendered any number of times,
+    also from several threads at once.
+    """
+    return generator.to_source(tree, **options)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import codegen
+    import codegen_objc
+
+    parser = argparse.ArgumentParser(description='Translates a Python file '
+                                     'with both code generators.')
+    parser.add_argument('filename', metavar='input.py')
+    parser.add_argument('--python', metavar='OUT',
+                        help='write the codegen output to OUT')
+    parser.add_argument('--objc', metavar='OUT',
+                        help='write the codegen_objc output to OUT')
+    parser.add_argument('--optimize', action='store_true',
+                        help='fold constants and drop dead code first')
+    args = parser.parse_args()
+
+    with open(args.filename, 'r') as f:
+        tree = parse(f.read(), args.filename)
+    for generator, output_filename in ((codegen, args.python),
+                                       (codegen_objc, args.objc)):
+        if output_filename:
+            with open(output_filename, 'w') as f:
+                f.write(render(tree, generator, optimize=args.optimize))
+                f.write('\n')
@@ -9,6 +9,7 @@
     :license: BSD, see LICENSE for more details.
 """
 import ast
+import operator
 
 
 BOOLOP_SYMBOLS = {
@@ -20,6 +21,7 @@ BINOP_SYMBOLS = {
     ast.Add:        '+',
     ast.Sub:        '-',
     ast.Mult:       '*',
+    ast.MatMult:    '@',
     ast.Div:        '/',
     ast.FloorDiv:   '//',
     ast.Mod:        '%',
@@ -51,6 +53,80 @@ UNARYOP_SYMBOLS = {
     ast.USub:       '-'
 }
 
+BOOLOP_OPERATORS = {
+    ast.And:        lambda a, b: a and b,
+    ast.Or:         lambda a, b: a or b
+}
+
+BINOP_OPERATORS = {
+    ast.Add:        operator.add,
+    ast.Sub:        operator.sub,
+    ast.Mult:       operator.mul,
+    ast.MatMult:    operator.matmul,
+    ast.Div:        operator.truediv,
+    ast.FloorDiv:   operator.floordiv,
+    ast.Mod:        operator.mod,
+    ast.LShift:     operator.lshift,
+    ast.RShift:     operator.rshift,
+    ast.BitOr:      operator.or_,
+    ast.BitAnd:     operator.and_,
+    ast.BitXor:     operator.xor,
+    ast.Pow:        operator.pow
+}
+
+CMPOP_OPERATORS = {
+    ast.Eq:         operator.eq,
+    ast.Gt:         operator.gt,
+    ast.GtE:        operator.ge,
+    ast.In:         lambda a, b: a in b,
+    ast.Is:         operator.is_,
+    ast.IsNot:      operator.is_not,
+    ast.Lt:         operator.lt,
+    ast.LtE:        operator.le,
+    ast.NotEq:      operator.ne,
+    ast.NotIn:      lambda a, b: a not in b
+}
+
+UNARYOP_OPERATORS = {
+    ast.Invert:     operator.invert,
+    ast.Not:        operator.not_,
+    ast.UAdd:       operator.pos,
+    ast.USub:       operator.neg
+}
+
+# How tightly operators and expressions that are not atoms bind, loosest
+# first.  Operands that bind more loosely than their position requires are
+# put in parentheses.  Yield expressions are always put in parentheses
+# unless they make up a statement or the value of an assignment.
+PRECEDENCE = {
+    ast.Lambda:     1,
+    ast.IfExp:      2,
+    ast.Or:         3,
+    ast.And:        4,
+    ast.Not:        5,
+    ast.Compare:    6,
+    ast.BitOr:      7,
+    ast.BitXor:     8,
+    ast.BitAnd:     9,
+    ast.LShift:     10,
+    ast.RShift:     10,
+    ast.Add:        11,
+    ast.Sub:        11,
+    ast.Mult:       12,
+    ast.MatMult:    12,
+    ast.Div:        12,
+    ast.FloorDiv:   12,
+    ast.Mod:        12,
+    ast.Invert:     13,
+    ast.UAdd:       13,
+    ast.USub:       13,
+    ast.Pow:        14,
+    ast.Await:      15
+}
+
+# Names, literals, calls, attribute accesses and subscripts.
+ATOM_PRECEDENCE = 16
+
 ALL_SYMBOLS = {}
 ALL_SYMBOLS.update(BOOLOP_SYMBOLS)
 ALL_SYMBOLS.update(BINOP_SYMBOLS)
@@ -67,3 +143,15 @@ def lookup_node(name):
         except TypeError:
             pass
     raise LookupError('Node %r not found' % name)
+
+
+def precedence(node):
+    """Returns how tightly the expression `node` binds."""
+    if isinstance(node, (ast.BoolOp, ast.BinOp, ast.UnaryOp)):
+        return PRECEDENCE[type(node.op)]
+    elif isinstance(node, ast.Constant) and \
+         isinstance(node.value, (int, float, complex)) and \
+         repr(node.value).startswith('-'):
+        # written with a unary minus
+        return PRECEDENCE[ast.USub]
+    return PRECEDENCE.get(type(node), ATOM_PRECEDENCE)
@@ -22,6 +22,7 @@ BINOP_SYMBOLS = {
     ast.Add:        '+',
     ast.Sub:        '-',
     ast.Mult:       '*',
+    ast.MatMult:    '@', # CHANGEME: no matrix multiplication in ObjC either
     ast.Div:        '/',
     ast.FloorDiv:   '//',
     ast.Mod:        '%',
@@ -29,7 +30,7 @@ BINOP_SYMBOLS = {
     ast.RShift:     '>>',
     ast.BitOr:      '|',
     ast.BitAnd:     '&',
-    ast.BitXor:     '^'
+    ast.BitXor:     '^',
     ast.Pow:        '**' # CHANGEME: pow is not an operator in ObjC!
 }
 
@@ -53,6 +54,44 @@ UNARYOP_SYMBOLS = {
     ast.USub:       '-'
 }
 
+# How tightly the C operators bind, loosest first.  Operands that bind more
+# loosely than their position requires are put in parentheses.
+PRECEDENCE = {
+    ast.IfExp:      3,
+    ast.Or:         4,
+    ast.And:        5,
+    ast.BitOr:      6,
+    ast.BitXor:     7,
+    ast.BitAnd:     8,
+    ast.Eq:         9,
+    ast.NotEq:      9,
+    ast.Is:         9,
+    ast.IsNot:      9,
+    ast.In:         9,
+    ast.NotIn:      9,
+    ast.Lt:         10,
+    ast.LtE:        10,
+    ast.Gt:         10,
+    ast.GtE:        10,
+    ast.LShift:     11,
+    ast.RShift:     11,
+    ast.Add:        12,
+    ast.Sub:        12,
+    ast.Mult:       13,
+    ast.MatMult:    13,
+    ast.Div:        13,
+    ast.FloorDiv:   13,
+    ast.Mod:        13,
+    ast.Pow:        13, # see BINOP_SYMBOLS
+    ast.Invert:     14,
+    ast.Not:        14,
+    ast.UAdd:       14,
+    ast.USub:       14
+}
+
+# Names, literals, calls, message sends and subscripts.
+ATOM_PRECEDENCE = 15
+
 ALL_SYMBOLS = {}
 ALL_SYMBOLS.update(BOOLOP_SYMBOLS)
 ALL_SYMBOLS.update(BINOP_SYMBOLS)
@@ -69,3 +108,17 @@ def lookup_node(name):
         except TypeError:
             pass
     raise LookupError('Node %r not found' % name)
+
+
+def precedence(node):
+    """Returns how tightly the expression `node` binds."""
+    if isinstance(node, (ast.BoolOp, ast.BinOp, ast.UnaryOp)):
+        return PRECEDENCE[type(node.op)]
+    elif isinstance(node, ast.Compare):
+        return min(PRECEDENCE[type(op)] for op in node.ops)
+    elif isinstance(node, ast.Constant) and \
+         isinstance(node.value, (int, float, complex)) and \
+         repr(node.value).startswith('-'):
+        # written with a unary minus
+        return PRECEDENCE[ast.USub]
+    return PRECEDENCE.get(type(node), ATOM_PRECEDENCE)
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+    optimize
+    ~~~~~~~~
+
+    AST optimization pass that can be run before either code generator,
+    e.g. with the `optimize` argument of their `to_source`.
+
+    It folds constant expressions, prunes branches and loops whose condition
+    is constant and drops code that can never run because it follows a
+    `return`, `raise`, `break` or `continue`.
+
+    :license: BSD, see LICENSE for more details.
+"""
+import math
+from ast import AST, NodeTransformer, Constant, Name, Load, Store, Del, Pass, \
+     UnaryOp, USub, Mult, Pow, LShift, Return, Raise, Break, Continue, Yield, \
+     YieldFrom, Global, Nonlocal, FunctionDef, AsyncFunctionDef, ClassDef, \
+     Lambda, Import, ImportFrom, ExceptHandler, MatchAs, MatchStar, \
+     MatchMapping, comprehension, copy_location, iter_child_nodes, \
+     iter_fields, walk
+from mapping import BOOLOP_OPERATORS, BINOP_OPERATORS, CMPOP_OPERATORS, \
+     UNARYOP_OPERATORS
+
+
+# Folded strings and numbers bigger than this are left as expressions, so
+# that folding never blows up the size of the generated code.
+MAX_FOLDED_SIZE = 4096
+
+STATEMENT_FIELDS = ('body', 'orelse', 'finalbody')
+
+NOT_CONSTANT = object()
+
+
+def optimize(node, constants=None):
+    """Optimizes the node tree `node` in place and returns it.
+
+    `constants` maps names to values that are known at translation time.
+    This is useful to drop debugging code, e.g. ``constants={'DEBUG':
+    False}`` removes every ``if DEBUG:`` block.
+    """
+    return Optimizer(constants).visit(node)
+
+
+def is_number(node):
+    return isinstance(node, Constant) and \
+           type(node.value) in (int, float, complex)
+
+
+def constant_value(node):
+    """Returns the value of the literal `node` or `NOT_CONSTANT`."""
+    if isinstance(node, Constant):
+        return node.value
+    elif isinstance(node, UnaryOp) and isinstance(node.op, USub) and \
+         is_number(node.operand):
+        return -node.operand.value
+    return NOT_CONSTANT
+
+
+def make_constant(value, node):
+    """Returns a literal node for `value` located at `node`, or `None` if
+    `value` can't be written as a literal of reasonable size.
+    """
+    if value is None or isinstance(value, bool):
+        result = Constant(value=value)
+    elif isinstance(value, int):
+        if abs(value).bit_length() > MAX_FOLDED_SIZE:
+            return None
+        result = Constant(value=value)
+    elif isinstance(value, float):
+        if math.isinf(value) or math.isnan(value):
+            return None
+        result = Constant(value=value)
+    elif isinstance(value, (str, bytes)):
+        if len(value) > MAX_FOLDED_SIZE:
+            return None
+        result = Constant(value=value)
+    else:
+        return None
+    if is_number(result) and value < 0:
+        # keep the sign out of the literal, `-1 ** 2` is `-(1 ** 2)`
+        result = UnaryOp(op=USub(), operand=Constant(value=-value))
+        copy_location(result.operand, node)
+    return copy_location(result, node)
+
+
+def folded_size(op, left, right):
+    """Estimates the size of ``left op right`` the way `make_constant`
+    measures it (bits of integers, the length of strings) for the operators
+    whose results can get huge.  Returns 0 for everything else.
+    """
+    if isinstance(op, Pow):
+        if type(left) is int and type(right) is int and right > 0 and \
+           abs(left) > 1:
+            return abs(left).bit_length() * right
+    elif isinstance(op, Mult):
+        for sequence, count in ((left, right), (right, left)):
+            if isinstance(sequence, (str, bytes, tuple)) and \
+               isinstance(count, int):
+                return len(sequence) * count
+        if isinstance(left, int) and isinstance(right, int):
+            return abs(left).bit_length() + abs(right).bit_length()
+    elif isinstance(op, LShift):
+        if isinstance(left, int) and isinstance(right, int) and right > 0:
+            return abs(left).bit_length() + right
+    return 0
+
+
+def fold(function, node, *args):
+    """Computes `function(*args)` and returns the result as literal node, or
+    `node` itself if that is not possible.
+    """
+    try:
+        value = function(*args)
+    except Exception:
+        return node
+    return make_constant(value, node) or node
+
+
+def binds_names(statements):
+    """Checks if `statements` bind a name in the scope they are in.  Names
+    bound in nested functions, classes, lambdas and by the targets of
+    comprehensions belong to scopes of their own.
+    """
+    todo = list(statements)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (FunctionDef, AsyncFunctionDef, ClassDef,
+                             Import, ImportFrom)):
+            return True
+        elif isinstance(node, Name):
+            if isinstance(node.ctx, (Store, Del)):
+                return True
+        elif isinstance(node, ExceptHandler) and node.name is not None:
+            return True
+        elif isinstance(node, (MatchAs, MatchStar)) and node.name is not None:
+            return True
+        elif isinstance(node, MatchMapping) and node.rest is not None:
+            return True
+        elif isinstance(node, Lambda):
+            continue
+        elif isinstance(node, comprehension):
+            # an assignment expression in the conditions still binds here
+            todo.append(node.iter)
+            todo.extend(node.ifs)
+            continue
+        todo.extend(iter_child_nodes(node))
+    return False
+
+
+def can_drop(statements, scoped):
+    """Checks if `statements` can be removed without changing the meaning of
+    the code around them.  A `yield` makes a function a generator and a
+    `global` or `nonlocal` declaration affects the whole function, even if
+    they are never executed.  In a function or class body (if `scoped` is
+    set) the same goes for every name the statements bind: without them a
+    name could refer to a variable of an outer scope instead.
+    """
+    for statement in statements:
+        for node in walk(statement):
+            if isinstance(node, (Yield, YieldFrom, Global, Nonlocal)):
+                return False
+    return not (scoped and binds_names(statements))
+
+
+class Optimizer(NodeTransformer):
+    """Folds constants and removes dead code.  See `optimize`."""
+
+    def __init__(self, constants=None):
+        self.constants = constants or {}
+        # the number of function and class bodies around the current node
+        self.scopes = 0
+
+    def generic_visit(self, node):
+        for field, old_value in iter_fields(node):
+            if field in STATEMENT_FIELDS and isinstance(old_value, list):
+                setattr(node, field, self.visit_statements(old_value))
+            elif isinstance(old_value, list):
+                new_values = []
+                for value in old_value:
+                    if isinstance(value, AST):
+                        value = self.visit(value)
+                        if value is None:
+                            continue
+                        elif not isinstance(value, AST):
+                            new_values.extend(value)
+                            continue
+                    new_values.append(value)
+                old_value[:] = new_values
+            elif isinstance(old_value, AST):
+                new_node = self.visit(old_value)
+                if new_node is None:
+                    delattr(node, field)
+                else:
+                    setattr(node, field, new_node)
+        return node
+
+    def visit_statements(self, statements):
+        """Returns the optimized version of the list `statements`.  Code after
+        a `return`, `raise`, `break` or `continue` is dropped and a `pass`
+        statement is put in if no statement is left.
+        """
+        result = []
+        for statement in statements:
+            statement = self.visit(statement)
+            if statement is None:
+                continue
+            elif isinstance(statement, list):
+                result.extend(statement)
+            else:
+                result.append(statement)
+        for idx, statement in enumerate(result):
+            if isinstance(statement, (Return, Raise, Break, Continue)):
+                if can_drop(result[idx + 1:], self.scopes):
+                    del result[idx + 1:]
+                break
+        if statements and not result:
+            result.append(copy_location(Pass(), statements[0]))
+        return result
+
+    # Statements
+
+    def visit_scope(self, node):
+        self.scopes += 1
+        self.generic_visit(node)
+        self.scopes -= 1
+        return node
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_ClassDef = \
+        visit_Lambda = visit_scope
+
+    def visit_If(self, node):
+        self.generic_visit(node)
+        test = constant_value(node.test)
+        if test is NOT_CONSTANT:
+            return node
+        taken, dropped = test and (node.body, node.orelse) or \
+                         (node.orelse, node.body)
+        if not can_drop(dropped, self.scopes):
+            return node
+        return taken or None
+
+    def visit_While(self, node):
+        self.generic_visit(node)
+        test = constant_value(node.test)
+        if test is NOT_CONSTANT or test or \
+           not can_drop(node.body, self.scopes):
+            return node
+        return node.orelse or None
+
+    # Expressions
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, Load) and node.id in self.constants:
+            return make_constant(self.constants[node.id], node) or node
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        left = constant_value(node.left)
+        right = constant_value(node.right)
+        if left is NOT_CONSTANT or right is NOT_CONSTANT:
+            return node
+        if folded_size(node.op, left, right) > MAX_FOLDED_SIZE:
+            return node
+        return fold(BINOP_OPERATORS[type(node.op)], node, left, right)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        operand = constant_value(node.operand)
+        if operand is NOT_CONSTANT:
+            return node
+        if isinstance(node.op, USub) and is_number(node.operand) and \
+           (isinstance(operand, complex) or operand > 0):
+            # already as folded as it gets
+            return node
+        return fold(UNARYOP_OPERATORS[type(node.op)], node, operand)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        function = BOOLOP_OPERATORS[type(node.op)]
+        values = list(node.values)
+        # a leading constant either decides the result or can be dropped
+        while len(values) > 1:
+            value = constant_value(values[0])
+            if value is NOT_CONSTANT:
+                break
+            if function(value, True) is not True or \
+               function(value, False) is not False:
+                return values[0]
+            values.pop(0)
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        operands = [constant_value(operand)
+                    for operand in [node.left] + node.comparators]
+        if NOT_CONSTANT in operands:
+            return node
+        def compare():
+            for op, left, right in zip(node.ops, operands, operands[1:]):
+                if not CMPOP_OPERATORS[type(op)](left, right):
+                    return False
+            return True
+        return fold(compare, node)
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        test = constant_value(node.test)
+        if test is NOT_CONSTANT:
+            return node
+        return test and node.body or node.orelse
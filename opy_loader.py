@@ -1,6 +1,22 @@
 import sys
 import os
 import re
+import ast
+import atexit
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import marshal
+import mmap
+import site
+import struct
+import sysconfig
+import zipfile
+from timeit import default_timer
+
+# Set this environment variable to get a report of the import statistics on
+# stderr when the interpreter exits.
+STATS_ENVIRONMENT_VARIABLE = 'OPY_LOADER_STATS'
 
 def split_respecting_parens(string, tokenizers=' \t'):
     result = []
@@ -61,32 +77,431 @@ def convert_to_python_call(method_call, add_self=False):
 
     return '%s.%s_(%s)' % (m.groupdict()['object'], '_'.join(keys), ', '.join(values))
 
+def convert_opy_line(line):
+    """Converts one line of `.opy` code.  The result is always exactly one
+    line, so line numbers stay the same.
+    """
+    m = re.match(r'(?P<spaces>\s*)(?P<rest>.*)', line)
+    if m:
+        foo = m.groupdict()['spaces']+fix_method_call(m.groupdict()['rest'])
+        if not foo.endswith('\n'):
+            foo += '\n'
+        return foo
+    return line
+
 def convert_opy_to_py(source_filename, destination_filename):
+    """Converts the file `source_filename` and returns the number of lines
+    converted and bytes written.
+    """
+    lines = 0
+    written = 0
     src = open(source_filename, 'r')
     dst = open(destination_filename, 'w')
     for line in src.readlines():
-        m = re.match(r'(?P<spaces>\s*)(?P<rest>.*)', line)
-        if m:
-            foo = m.groupdict()['spaces']+fix_method_call(m.groupdict()['rest'])
-            dst.write(foo)
-            if not foo.endswith('\n'):
-                dst.write('\n')
-        else:
-            dst.write(line)
+        foo = convert_opy_line(line)
+        dst.write(foo)
+        lines += 1
+        written += len(foo)
     src.close()
     dst.close()
+    return lines, written
+
+def parse_opy(source, filename='<opy>'):
+    """Parses the `.opy` code `source` into an `ast.Module`, which can be
+    passed to `compile` or to the code generators.  The conversion happens
+    in memory and line by line, so the line numbers of the nodes are the
+    ones in `source` and tracebacks point at the `.opy` file.
+    """
+    lines = [convert_opy_line(line) for line in source.splitlines(True)]
+    return ast.parse(''.join(lines), filename)
+
+def compile_opy(filename):
+    """Returns the code object of the `.opy` file `filename` and the number
+    of lines in it.
+    """
+    f = open(filename, 'r')
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    node = parse_opy(source, filename)
+    return compile(node, filename, 'exec'), source.count('\n')
+
+class OpyLoader(importlib.abc.Loader):
+    """Loads a `.opy` module straight from its source, without writing a
+    `.py` file.
+    """
+
+    def __init__(self, filename, module_stats):
+        self.filename = filename
+        self.module_stats = module_stats
+
+    def get_code(self, fullname):
+        start = default_timer()
+        code, lines = compile_opy(self.filename)
+        elapsed = default_timer() - start
+        self.module_stats.conversion_time += elapsed
+        self.module_stats.hook_time += elapsed
+        self.module_stats.lines_converted += lines
+        return code
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+class ConvertingLoader(importlib.abc.Loader):
+    """Converts a `.opy` module to a `.py` file next to it, unless that is
+    up to date, and loads the `.py` file.
+    """
+
+    def __init__(self, filename, module_stats):
+        self.filename = filename
+        self.py_filename = filename[:-len('.opy')] + '.py'
+        self.module_stats = module_stats
+
+    def convert(self):
+        """Converts the `.opy` file if the `.py` file is out of date and
+        returns whether it did.
+        """
+        start = default_timer()
+        try:
+            return self.convert_if_changed()
+        finally:
+            self.module_stats.hook_time += default_timer() - start
+
+    def convert_if_changed(self):
+        module_stats = self.module_stats
+        module_stats.stat_calls += 1
+        try:
+            opy_mtime = os.stat(self.filename).st_mtime
+        except OSError:
+            return False
+        module_stats.stat_calls += 1
+        try:
+            up_to_date = os.stat(self.py_filename).st_mtime >= opy_mtime
+        except OSError:
+            up_to_date = False
+        if up_to_date:
+            module_stats.cache_hits += 1
+            return False
+        module_stats.cache_misses += 1
+        start = default_timer()
+        lines, written = convert_opy_to_py(self.filename, self.py_filename)
+        module_stats.conversion_time += default_timer() - start
+        module_stats.lines_converted += lines
+        module_stats.bytes_written += written
+        return True
+
+    def exec_module(self, module):
+        # the .py file gets the usual bytecode caching
+        self.convert()
+        importlib.machinery.SourceFileLoader(
+            module.__name__, self.py_filename).exec_module(module)
+
+class ModuleStats(object):
+    """What importing one module cost the import hook.  `hook_time` is the
+    time spent looking for the module plus the time spent getting its code
+    ready, i.e. converting it, or parsing and compiling it in direct mode,
+    whenever that happens.
+    """
+
+    def __init__(self):
+        self.stat_calls = 0
+        self.conversion_time = 0.0
+        self.lines_converted = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_written = 0
+        self.hook_time = 0.0
+
+    def add(self, other):
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+class ImportStats(object):
+    """Statistics of all imports that went through the `MetaImporter`.
+    Only the `.opy` modules get a row of their own, the cost of looking at
+    all other imports is summed up in `other`.
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self.other = ModuleStats()
+
+    def module(self, fullname):
+        if fullname not in self.modules:
+            self.modules[fullname] = ModuleStats()
+        return self.modules[fullname]
+
+    def total(self):
+        total = ModuleStats()
+        for module in self.modules.values():
+            total.add(module)
+        total.add(self.other)
+        return total
+
+    def report(self):
+        lines = ['%-32s %6s %6s %6s %8s %10s %10s %10s' % (
+            'module', 'stats', 'hits', 'misses', 'lines', 'bytes', 'convert',
+            'hook')]
+        rows = sorted(self.modules.items(), key=lambda item: -item[1].hook_time)
+        rows.append(('(other modules)', self.other))
+        rows.append(('total', self.total()))
+        for fullname, module in rows:
+            lines.append('%-32s %6d %6d %6d %8d %10d %9.6fs %9.6fs' % (
+                fullname, module.stat_calls, module.cache_hits,
+                module.cache_misses, module.lines_converted,
+                module.bytes_written, module.conversion_time,
+                module.hook_time))
+        return '\n'.join(lines)
+
+stats = ImportStats()
+
+def print_stats():
+    sys.stderr.write(stats.report() + '\n')
+
+def default_excluded_directories():
+    """Returns the directories of the standard library and of installed
+    packages.  They never contain `.opy` modules, so the hook doesn't look
+    at them at all.
+    """
+    paths = sysconfig.get_paths()
+    directories = set(paths[key] for key in
+                      ('stdlib', 'platstdlib', 'purelib', 'platlib')
+                      if key in paths)
+    if hasattr(site, 'getsitepackages'):
+        directories.update(site.getsitepackages())
+    if hasattr(site, 'getusersitepackages'):
+        directories.add(site.getusersitepackages())
+    return tuple(os.path.normcase(os.path.abspath(directory))
+                 for directory in directories)
 
 class MetaImporter(object):
-    def find_module(self, fullname, path=None):
+    """Converts `.opy` modules to `.py` files right before they are imported
+    and leaves the actual importing to the regular finders.
+
+    With `direct` set the `.opy` modules are compiled in memory and loaded
+    by an `OpyLoader` instead.  With `lazy` set importing a `.opy` module
+    only creates a module that `importlib.util.LazyLoader` fills in, and the
+    conversion and loading is put off until the module is actually used.
+
+    Which directories contain which `.opy` modules is read once per
+    directory, and modules that turned out not to be `.opy` modules are
+    remembered, so that other imports cost next to nothing.  Call
+    `invalidate_caches` after adding `.opy` files at runtime.
+    """
+
+    def __init__(self, excluded_directories=None, direct=False, lazy=False):
+        if excluded_directories is None:
+            excluded_directories = default_excluded_directories()
+        self.excluded_directories = excluded_directories
+        self.direct = direct
+        self.lazy = lazy
+        self.directories = {}
+        self.missing = set()
+
+    def invalidate_caches(self):
+        self.directories.clear()
+        self.missing.clear()
+
+    def is_excluded(self, directory):
+        directory = os.path.normcase(os.path.abspath(directory))
+        for excluded in self.excluded_directories:
+            if directory == excluded or \
+               directory.startswith(excluded.rstrip(os.sep) + os.sep):
+                return True
+        return False
+
+    def opy_modules(self, directory, module_stats):
+        """Returns the names of the `.opy` modules in `directory`."""
+        names = self.directories.get(directory)
+        if names is None:
+            names = frozenset()
+            if not self.is_excluded(directory):
+                module_stats.stat_calls += 1
+                try:
+                    names = frozenset(filename[:-len('.opy')] for filename in
+                                      os.listdir(directory or os.curdir)
+                                      if filename.endswith('.opy'))
+                except (OSError, TypeError):
+                    pass
+            self.directories[directory] = names
+        return names
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname in self.missing:
+            return None
+        start = default_timer()
+        # only .opy modules get a row in the stats
+        search_stats = ModuleStats()
         lastname = fullname.rsplit('.', 1)[-1]
         for d in (path or sys.path):
-            filename = os.path.join(d, lastname + '.opy')
-            if os.path.exists(filename):
-                convert_opy_to_py(filename, os.path.join(d, lastname+'.py'))
+            if lastname in self.opy_modules(d, search_stats):
+                break
+        else:
+            self.missing.add(fullname)
+            search_stats.hook_time += default_timer() - start
+            stats.other.add(search_stats)
+            return None
+
+        module_stats = stats.module(fullname)
+        module_stats.add(search_stats)
+        filename = os.path.join(d, lastname + '.opy')
+        spec = None
+        if self.direct:
+            module_stats.cache_misses += 1
+            loader = OpyLoader(filename, module_stats)
+        else:
+            loader = ConvertingLoader(filename, module_stats)
+        if self.direct or self.lazy:
+            if self.lazy:
+                loader = importlib.util.LazyLoader(loader)
+            spec = importlib.util.spec_from_file_location(fullname, filename,
+                                                          loader=loader)
+        module_stats.hook_time += default_timer() - start
+        if spec is None and loader.convert():
+            # the regular finders import the converted file, but they cache
+            # the directory listing from before it was written
+            finder = sys.path_importer_cache.get(d)
+            if finder is not None:
+                finder.invalidate_caches()
+        return spec
+
+importer = MetaImporter()
+
+def install(direct=False, lazy=False):
+    """Puts the `.opy` hook in front of the interpreter's own finders.  See
+    `MetaImporter` for `direct` and `lazy`.
+    """
+    importer.direct = direct
+    importer.lazy = lazy
+    if importer not in sys.meta_path:
+        sys.meta_path.insert(0, importer)
+
+def uninstall():
+    if importer in sys.meta_path:
+        sys.meta_path.remove(importer)
+
+# Bundles
+
+BUNDLE_INDEX = '__index__'
+BUNDLE_FORMAT_VERSION = 1
+
+def bundle_sources(directory, package=''):
+    """Yields the module name, package flag and filename of every `.opy` and
+    `.py` module in `directory` and the packages below it.
+    """
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if os.path.isdir(path):
+            for init in ('__init__.opy', '__init__.py'):
+                if os.path.exists(os.path.join(path, init)):
+                    yield package + filename, True, os.path.join(path, init)
+                    for source in bundle_sources(path,
+                                                 package + filename + '.'):
+                        yield source
+                    break
+        elif filename.endswith(('.opy', '.py')):
+            name = os.path.splitext(filename)[0]
+            if name == '__init__':
+                continue
+            if filename.endswith('.py') and \
+               os.path.exists(path[:-len('.py')] + '.opy'):
+                # converted from the .opy file
+                continue
+            yield package + name, False, path
+
+def build_bundle(directory, bundle_filename):
+    """Compiles every module in the tree `directory` (which would be on
+    `sys.path`) into the bundle archive `bundle_filename`.  The archive is a
+    zip file of marshalled code objects and an index of the modules.
+    """
+    modules = {}
+    bundle = zipfile.ZipFile(bundle_filename, 'w', zipfile.ZIP_STORED)
+    try:
+        for fullname, is_package, path in bundle_sources(directory):
+            relative_path = os.path.relpath(path, directory)
+            filename = os.path.join(bundle_filename, relative_path)
+            f = open(path, 'r')
+            try:
+                source = f.read()
+            finally:
+                f.close()
+            if path.endswith('.opy'):
+                node = parse_opy(source, filename)
+            else:
+                node = ast.parse(source, filename)
+            member = os.path.splitext(relative_path)[0] + '.pyc'
+            bundle.writestr(member, marshal.dumps(compile(node, filename,
+                                                          'exec')))
+            modules[fullname] = (member, is_package, filename)
+        bundle.writestr(BUNDLE_INDEX, marshal.dumps({
+            'version': BUNDLE_FORMAT_VERSION,
+            'magic': importlib.util.MAGIC_NUMBER,
+            'modules': modules,
+        }))
+    finally:
+        bundle.close()
+
+class BundleImporter(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Imports modules from a bundle made by `build_bundle`.  The bundle is
+    mapped into memory once and the code of a module is unmarshalled
+    straight from the mapping, without any further file system access.
+    """
+
+    def __init__(self, bundle_filename):
+        self.bundle_filename = bundle_filename
+        f = open(bundle_filename, 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            bundle = zipfile.ZipFile(f)
+            index = marshal.loads(bundle.read(BUNDLE_INDEX))
+        finally:
+            f.close()
+        if index['version'] != BUNDLE_FORMAT_VERSION or \
+           index['magic'] != importlib.util.MAGIC_NUMBER:
+            raise ImportError('%s was built for another Python version' %
+                              bundle_filename)
+        self.modules = {}
+        for fullname, (member, is_package, filename) in \
+                index['modules'].items():
+            info = bundle.getinfo(member)
+            start = info.header_offset + 30
+            name_length, extra_length = struct.unpack(
+                '<HH', self.data[start - 4:start])
+            start += name_length + extra_length
+            self.modules[fullname] = (start, start + info.file_size,
+                                      is_package, filename)
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self.modules:
+            return None
+        start, end, is_package, filename = self.modules[fullname]
+        spec = importlib.machinery.ModuleSpec(fullname, self, origin=filename,
+                                              is_package=is_package)
+        spec.has_location = True
+        if is_package:
+            spec.submodule_search_locations.append(os.path.dirname(filename))
+        return spec
+
+    def exec_module(self, module):
+        start, end, is_package, filename = self.modules[module.__name__]
+        exec(marshal.loads(self.data[start:end]), module.__dict__)
+
+def install_bundle(bundle_filename):
+    """Serves imports from the bundle `bundle_filename` before all other
+    finders and returns the `BundleImporter` doing it.
+    """
+    bundle_importer = BundleImporter(bundle_filename)
+    sys.meta_path.insert(0, bundle_importer)
+    return bundle_importer
 
-        return None
+install()
 
-sys.meta_path = [MetaImporter()]
+if os.environ.get(STATS_ENVIRONMENT_VARIABLE):
+    atexit.register(print_stats)
 
 if __name__ == '__main__':
-    import opy_test
\ No newline at end of file
+    if len(sys.argv) == 4 and sys.argv[1] == 'bundle':
+        build_bundle(sys.argv[2], sys.argv[3])
+    else:
+        import opy_test
\ No newline at end of file
@@ -1,8 +1,8 @@
-print 'imported opy_test!'
+print('imported opy_test!')
 
 class Foo:
 	def foo_bar_(self, foo1, bar):
-	    print 'success!'
+	    print('success!')
 	
 	def bar(self):
 	    return 0
@@ -10,7 +10,7 @@ class Foo:
 foo = Foo()
 foo.foo_bar_(1, foo.bar())
 
-print [x*2 for x in [1, 2, 3]]
+print([x*2 for x in [1, 2, 3]])
 
 [[anObjecr proxy] extend:[3,4] with:[a, b.c() ]]
 foo..baz_(bar)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    profiling
+    ~~~~~~~~~
+
+    Profiling instrumentation for the code generators.
+
+    Pass a `Profiler` to `codegen.to_source` or `codegen_objc.to_source` and
+    it records, per AST node type and per `visit_*` method, how often it was
+    called, the cumulative and self time spent in it and how many bytes of
+    output it produced::
+
+        profiler = Profiler()
+        source = to_source(node, profiler=profiler)
+        print(profiler.report())
+
+    `Profiler.write_folded` dumps the time per node type stack in the folded
+    format understood by flame graph tools.
+
+    :license: BSD, see LICENSE for more details.
+"""
+from timeit import default_timer
+
+
+class Stat(object):
+    """Counters for one node type or method."""
+
+    __slots__ = ('calls', 'cumulative', 'self_time', 'bytes', 'active')
+
+    def __init__(self):
+        self.calls = 0
+        self.cumulative = 0.0
+        self.self_time = 0.0
+        self.bytes = 0
+        self.active = 0
+
+
+class CountingStream(object):
+    """Forwards writes to `stream` and counts the bytes written."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def write(self, x):
+        self.bytes += len(x)
+        self.stream.write(x)
+
+
+class Profiler(object):
+    """Collects the statistics of every generator it instruments."""
+
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        self.node_stats = {}
+        self.method_stats = {}
+        self.stacks = {}
+        self.node_path = []
+
+    def instrument(self, generator):
+        """Instruments the `SourceGenerator` instance `generator`.  Only the
+        instance is changed, other generators keep running at full speed.
+        """
+        counter = CountingStream(generator.stream)
+        generator.stream = counter
+        node_frames = []
+        method_frames = []
+
+        def enter(frames, stats, key):
+            stat = stats.get(key)
+            if stat is None:
+                stat = stats[key] = Stat()
+            stat.calls += 1
+            stat.active += 1
+            # [stat, start time, start bytes, children time, children bytes]
+            frame = [stat, self.timer(), counter.bytes, 0.0, 0]
+            frames.append(frame)
+            return frame
+
+        def leave(frames):
+            stat, start, start_bytes, children, children_bytes = frames.pop()
+            elapsed = self.timer() - start
+            written = counter.bytes - start_bytes
+            stat.active -= 1
+            if not stat.active:
+                # recursive calls are part of the outermost one
+                stat.cumulative += elapsed
+            stat.self_time += elapsed - children
+            stat.bytes += written - children_bytes
+            if frames:
+                frames[-1][3] += elapsed
+                frames[-1][4] += written
+            return elapsed - children
+
+        visit = generator.visit
+        def profiled_visit(node):
+            name = node.__class__.__name__
+            enter(node_frames, self.node_stats, name)
+            self.node_path.append(name)
+            try:
+                return visit(node)
+            finally:
+                self_time = leave(node_frames)
+                path = ';'.join(self.node_path)
+                self.stacks[path] = self.stacks.get(path, 0.0) + self_time
+                self.node_path.pop()
+        generator.visit = profiled_visit
+
+        def wrap(name, method):
+            def profiled_method(*args, **kwargs):
+                enter(method_frames, self.method_stats, name)
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    leave(method_frames)
+            return profiled_method
+
+        for name in dir(generator):
+            if name.startswith('visit_'):
+                setattr(generator, name, wrap(name, getattr(generator, name)))
+
+    def report(self, limit=None):
+        """Returns the collected statistics as a table, most expensive node
+        types and methods first.
+        """
+        lines = []
+        for title, stats in (('node type', self.node_stats),
+                             ('method', self.method_stats)):
+            lines.append('%-24s %10s %12s %12s %12s' % (
+                title, 'calls', 'cumulative', 'self', 'bytes'))
+            items = sorted(stats.items(), key=lambda item: -item[1].cumulative)
+            for name, stat in items[:limit]:
+                lines.append('%-24s %10d %11.6fs %11.6fs %12d' % (
+                    name, stat.calls, stat.cumulative, stat.self_time,
+                    stat.bytes))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def write_folded(self, stream):
+        """Writes the self time in microseconds of every stack of node types
+        to `stream`, one ``Module;ClassDef;FunctionDef 1234`` line each.
+        """
+        for path in sorted(self.stacks):
+            stream.write('%s %d\n' % (path, round(self.stacks[path] * 1e6)))
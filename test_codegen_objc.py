@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    test_codegen_objc
+    ~~~~~~~~~~~~~~~~~
+
+    Compares the text `codegen_objc` generates for small modules.
+
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest
+from textwrap import dedent
+
+import codegen_objc
+import frontend
+
+
+def translate(source):
+    return codegen_objc.to_source(frontend.parse(dedent(source), '<test>'))
+
+
+class PropertyTestCase(unittest.TestCase):
+
+    def test_own_attributes_use_ivars(self):
+        out = translate('''
+            class Card(NSObject):
+                count = 1
+                def setup(self):
+                    self.name = 'x'
+                    print(self.count)
+        ''')
+        self.assertIn('@property (nonatomic, assign) int count;', out)
+        self.assertIn('_name = @"x";', out)
+        self.assertIn('print(_count);', out)
+
+    def test_subclass_uses_inherited_accessors(self):
+        out = translate('''
+            class Card(NSObject):
+                count = 1
+            class Deck(Card):
+                count = 5
+                def fill(self):
+                    self.count = 2
+                    self.cards = 3
+        ''')
+        interface = out[out.index('@interface Deck'):]
+        interface = interface[:interface.index('@end')]
+        self.assertNotIn('count', interface)
+        self.assertIn('cards;', interface)
+        self.assertIn('self.count = 2;', out)
+        self.assertNotIn('_count', out)
+        self.assertIn('_cards = 3;', out)
+
+
+class OptimizeTestCase(unittest.TestCase):
+
+    def test_optimize_copies_the_tree(self):
+        tree = frontend.parse(dedent('''
+            def f(x):
+                if False:
+                    print(x)
+                return 2 ** 10 + x
+        '''), '<test>')
+        plain = codegen_objc.to_source(tree)
+        out = codegen_objc.to_source(tree, optimize=True)
+        self.assertIn('return 1024 + x;', out)
+        self.assertNotIn('print', out)
+        self.assertEqual(codegen_objc.to_source(tree), plain)
+
+
+class HeaderTestCase(unittest.TestCase):
+
+    def test_imported_superclass(self):
+        tree = frontend.parse(dedent('''
+            import os
+            import app.model
+            from app.model import Card
+            from Foundation import NSObject
+            class Deck(app.model.Card):
+                top = Card()
+            class Player(NSObject):
+                hand = Card()
+        '''), '<test>')
+        header, implementation = codegen_objc.to_files(tree, 'app.ui.deck')
+        self.assertIn('#import "app/model.h"\n', header)
+        self.assertIn('@interface Deck : Card\n', header)
+        self.assertNotIn('@class', header)
+        self.assertNotIn('os.h', implementation)
+        self.assertIn('#import <Foundation/Foundation.h>\n', implementation)
+
+
+class MembershipTestCase(unittest.TestCase):
+
+    def test_literal_containers(self):
+        out = translate('''
+            def check(kind, a, b):
+                print(kind in ('a', 'b'), kind not in (a, b), kind in (),
+                      kind not in [])
+        ''')
+        self.assertIn('([_membershipSet0() containsObject:kind])', out)
+        self.assertIn('(![@[a, b] containsObject:kind])', out)
+        self.assertIn(', NO, YES);', out)
+
+
+class SliceTestCase(unittest.TestCase):
+
+    def test_loop_variable_outlives_loop(self):
+        out = translate('''
+            def last(items):
+                for x in items[1:]:
+                    pass
+                for x in items[::2]:
+                    pass
+                return x
+        ''')
+        self.assertEqual(out.count('id x;'), 1)
+        self.assertLess(out.index('id x;'), out.index('for ('))
+        self.assertEqual(out.count('x = [items objectAtIndex:'), 2)
+
+
+class ParallelTestCase(unittest.TestCase):
+
+    def test_loops_run_in_parallel(self):
+        out = translate('''
+            @parallel
+            def scale(out):
+                for x in range(10):
+                    y = x * 2
+                    out[x] = y
+                for x in range(5):
+                    out[x] = x
+        ''')
+        self.assertEqual(out.count('dispatch_apply('), 2)
+        self.assertIn('NSInteger x = _start0 + (NSInteger)_i0;\n'
+                      '        NSInteger y;\n'
+                      '        y = x * 2;', out)
+        self.assertNotIn('runs sequentially', out)
+
+    def test_rebound_variable_runs_in_parallel(self):
+        out = translate('''
+            def scale(out):
+                # parallel
+                for i in range(10):
+                    z = i
+                    out[i] = z
+                z = 3
+                print(z)
+        ''')
+        self.assertIn('dispatch_apply(', out)
+
+    def test_fallback_to_sequential_loop(self):
+        out = translate('''
+            @parallel
+            def total(out, items):
+                for i in range(10):
+                    z = i
+                    out[i] = z
+                print(z)
+                while items:
+                    items = items.next
+        ''')
+        self.assertNotIn('dispatch_apply(', out)
+        self.assertIn('// parallel: runs sequentially, the loop body writes '
+                      'to the outer variable z', out)
+        self.assertIn('// parallel: runs sequentially, only for loops can '
+                      'run in parallel', out)
+
+
+if __name__ == '__main__':
+    unittest.main()
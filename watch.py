@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    watch
+    ~~~~~
+
+    Watches `.opy` sources and code generator inputs and converts the files
+    that changed.
+
+        python watch.py [--objc-out DIR] [--python-out DIR] path ...
+
+    `.opy` files are converted to the `.py` file next to them, just like
+    `opy_loader` does on import.  With `--objc-out` and `--python-out` the
+    `.py` files below `path` are also translated by `codegen_objc` (to a
+    `.h` and a `.m` file per module) and `codegen` into the matching
+    subdirectory of that directory.  Changes are found by polling, and a
+    burst of changes (e.g. a save that touches several files) is only
+    handled once it is over.
+
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+from timeit import default_timer
+
+import codegen
+import codegen_objc
+import frontend
+from opy_loader import convert_opy_to_py
+
+
+def translate(tree, generator, output_filename):
+    """Translates `tree` with the code generator module `generator` and
+    writes the result to `output_filename`.
+    """
+    os.makedirs(os.path.dirname(output_filename) or os.curdir, exist_ok=True)
+    with open(output_filename, 'w') as f:
+        f.write(frontend.render(tree, generator))
+        f.write('\n')
+
+
+def translate_objc(tree, module_name, output_directory, root=None):
+    """Translates `tree` to the Objective-C header and implementation file
+    of the module `module_name` of the project in `root`, and writes them
+    below `output_directory`.
+    """
+    header, implementation = codegen_objc.to_files(tree, module_name,
+                                                   root=root)
+    base = os.path.join(output_directory, os.path.splitext(
+        codegen_objc.header_filename(module_name))[0])
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    for extension, source in (('.h', header), ('.m', implementation)):
+        filename = base + extension
+        with open(filename, 'w') as f:
+            f.write(source)
+            f.write('\n')
+
+
+class Watcher(object):
+    """Polls the files below `paths` every `interval` seconds and converts
+    the ones that changed once nothing changed for `debounce` seconds.
+    """
+
+    def __init__(self, paths, objc_out=None, python_out=None, interval=0.5,
+                 debounce=0.2, stream=sys.stdout):
+        self.paths = paths
+        self.objc_out = objc_out
+        self.python_out = python_out
+        self.interval = interval
+        self.debounce = debounce
+        self.stream = stream
+        self.output_directories = [os.path.abspath(directory) for directory
+                                   in (objc_out, python_out) if directory]
+        self.mtimes = self.scan()
+        # path -> time its first change was seen
+        self.pending = {}
+        self.last_change = None
+
+    def is_input(self, pathname):
+        if pathname.endswith('.opy'):
+            return True
+        if not pathname.endswith('.py') or not self.output_directories:
+            return False
+        if os.path.exists(pathname[:-len('.py')] + '.opy'):
+            # converted from the .opy file
+            return False
+        directory = os.path.dirname(os.path.abspath(pathname))
+        for output_directory in self.output_directories:
+            if directory == output_directory or \
+               directory.startswith(output_directory + os.sep):
+                return False
+        return True
+
+    def inputs(self):
+        for path in self.paths:
+            if not os.path.isdir(path):
+                yield path
+                continue
+            for directory, directories, filenames in os.walk(path):
+                for filename in filenames:
+                    pathname = os.path.join(directory, filename)
+                    if self.is_input(pathname):
+                        yield pathname
+
+    def scan(self):
+        mtimes = {}
+        for pathname in self.inputs():
+            try:
+                mtimes[pathname] = os.stat(pathname).st_mtime
+            except OSError:
+                pass
+        return mtimes
+
+    def poll(self):
+        """Records the files that changed since the last poll."""
+        mtimes = self.scan()
+        now = default_timer()
+        for pathname, mtime in mtimes.items():
+            if self.mtimes.get(pathname) != mtime:
+                self.pending.setdefault(pathname, now)
+                self.last_change = now
+        self.mtimes = mtimes
+
+    def module_name(self, pathname):
+        """Returns the watched directory `pathname` is in and its dotted
+        module name relative to it.
+        """
+        for path in self.paths:
+            if not os.path.isdir(path):
+                continue
+            relative = os.path.relpath(pathname, path)
+            if relative != os.pardir and \
+               not relative.startswith(os.pardir + os.sep):
+                relative = os.path.splitext(relative)[0]
+                return path, relative.replace(os.sep, '.')
+        return os.path.dirname(pathname) or os.curdir, \
+               os.path.splitext(os.path.basename(pathname))[0]
+
+    def convert(self, pathname):
+        """Converts one changed file and returns how long that took."""
+        start = default_timer()
+        if pathname.endswith('.opy'):
+            convert_opy_to_py(pathname, pathname[:-len('.opy')] + '.py')
+        else:
+            root, name = self.module_name(pathname)
+            with open(pathname, 'r') as f:
+                tree = frontend.parse(f.read(), pathname)
+            if self.objc_out:
+                translate_objc(tree, name, self.objc_out, root)
+            if self.python_out:
+                translate(tree, codegen, os.path.join(
+                    self.python_out, *name.split('.')) + '.py')
+        return default_timer() - start
+
+    def flush(self):
+        """Converts the pending files if the burst of changes is over."""
+        if not self.pending or \
+           default_timer() - self.last_change < self.debounce:
+            return
+        pending, self.pending = self.pending, {}
+        for pathname in sorted(pending):
+            try:
+                elapsed = self.convert(pathname)
+            except Exception as e:
+                self.stream.write('%s: %s: %s\n' % (
+                    pathname, e.__class__.__name__, e))
+                continue
+            latency = default_timer() - pending[pathname]
+            self.stream.write('%s: converted in %.1f ms, %.1f ms after the '
+                              'change was noticed\n' % (
+                                  pathname, elapsed * 1000, latency * 1000))
+        self.stream.flush()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+            self.flush()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Converts .opy files and '
+                                     'translates Python files on change.')
+    parser.add_argument('paths', nargs='+', metavar='path')
+    parser.add_argument('--objc-out', metavar='DIR',
+                        help='translate .py files to Objective-C into DIR')
+    parser.add_argument('--python-out', metavar='DIR',
+                        help='regenerate .py files with codegen into DIR')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between polls')
+    parser.add_argument('--debounce', type=float, default=0.2,
+                        help='seconds without changes before converting')
+    args = parser.parse_args()
+
+    watcher = Watcher(args.paths, args.objc_out, args.python_out,
+                      args.interval, args.debounce)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass